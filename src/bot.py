@@ -1,80 +1,159 @@
 import datetime
+import functools
+import json
 import logging
-
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from typing import Callable, Dict, List
+
+from telegram import (
+    InlineKeyboardButton,
+    InlineKeyboardMarkup,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+    Update,
+)
 from telegram.constants import MessageLimit
 from telegram.ext import ContextTypes
-from translate import Translator
 
 import config
+import i18n
+from broadcast import Broadcaster
+from cache import LRUCache, TwoTierCache, timetable_key
 from db import (
-    get_groups_collection,
-    get_redis_connection,
-    get_teachers_collection,
-    get_timetables_collection,
-    get_users_collection,
+    get_async_groups_collection,
+    get_async_redis_connection,
+    get_async_teachers_collection,
+    get_async_timetables_collection,
+    get_async_users_collection,
+)
+from search import NameIndex
+from utils import (
+    CHANGES_KEY,
+    LAST_RUN_KEY,
+    LISTS_VERSION_KEY,
+    get_ongoing_week,
+    get_timetable,
+    known_ongoing_week,
+    load_week_calibrations,
+    send_message_by_chunks,
+    update_user,
 )
-from utils import get_ongoing_week, get_timetable, send_message_by_chunks, update_user
-
-translator = Translator(to_lang="en")
 
 
-def _(text):
-    return translator.translate(text)
+def N_(text):
+    """Marks text for the translation catalog without translating it"""
+    return text
 
 
 ACADEMIC_YEAR = config.ACADEMIC_YEAR
 DAYS = {
-    _("Monday"): "Понедельник",
-    _("Tuesday"): "Вторник",
-    _("Wednesday"): "Среда",
-    _("Thursday"): "Четверг",
-    _("Friday"): "Пятница",
-    _("Saturday"): "Суббота",
+    N_("Monday"): "Понедельник",
+    N_("Tuesday"): "Вторник",
+    N_("Wednesday"): "Среда",
+    N_("Thursday"): "Четверг",
+    N_("Friday"): "Пятница",
+    N_("Saturday"): "Суббота",
 }
-users_db = get_users_collection()
-groups_db = get_groups_collection()
-teachers_db = get_teachers_collection()
-timetables_db = get_timetables_collection()
-r = get_redis_connection()
-
-
-def insert_or_update_user(update: Update):
+users_db = get_async_users_collection()
+groups_db = get_async_groups_collection()
+teachers_db = get_async_teachers_collection()
+timetables_db = get_async_timetables_collection()
+r = get_async_redis_connection()
+timetable_cache = TwoTierCache(
+    r,
+    LRUCache(maxsize=config.LOCAL_CACHE_SIZE, ttl=config.LOCAL_CACHE_TTL),
+    ttl=config.CACHE_TTL,
+    generation_interval=config.CACHE_GENERATION_INTERVAL)
+# Callback data is namespaced as "<prefix>:<payload>" and routed by prefix
+SEMESTER_CALLBACK = 'sem'
+GROUP_CALLBACK = 'grp'
+TEACHER_CALLBACK = 'tch'
+DAY_CALLBACK = 'day'
+LANGUAGE_CALLBACK = 'lang'
+user_languages = LRUCache(maxsize=10000)
+group_index = NameIndex(min_similarity=config.SEARCH_MIN_SIMILARITY)
+teacher_index = NameIndex(min_similarity=config.SEARCH_MIN_SIMILARITY)
+# ISU values of the indexed names and back, as names may not fit in the
+# 64 bytes of callback data
+group_values: Dict[str, int] = {}
+group_names: Dict[int, str] = {}
+teacher_values: Dict[str, int] = {}
+teacher_names: Dict[int, str] = {}
+# Version of the lists the indexes were built from, None until built
+_lists_version = None
+
+
+async def get_language(user_id: int) -> str:
+    """Returns the user's language, reading the database once per user"""
+    language = user_languages.get(user_id)
+    if language is None:
+        user = await users_db.find_one({'user_id': user_id}, {'language': 1})
+        language = (user or {}).get('language', i18n.SOURCE_LANGUAGE)
+        user_languages.set(user_id, language)
+    return language
+
+
+async def gettext_for(update: Update) -> Callable[[str], str]:
+    """Returns `_` bound to the language of the update's chat"""
+    language = await get_language(update.effective_chat.id)
+    return functools.partial(i18n.gettext, language=language)
+
+
+def callback_data(prefix: str, payload) -> str:
+    """Builds the callback data of a button routed to the prefix's handler"""
+    return f'{prefix}:{payload}'
+
+
+def callback_payload(update: Update) -> str:
+    """Returns the callback data of the pressed button without its prefix"""
+    return update.callback_query.data.partition(':')[2]
+
+
+async def insert_or_update_user(update: Update):
     user_id = update.effective_chat.id
-    user = users_db.find_one({'user_id': user_id})
     username = update.effective_chat.username
-    users_db.update_one({
+    # A user writing to us has unblocked the bot if they ever blocked it
+    await users_db.update_one({
         'user_id': user_id,
-    }, {'$set': {
-        'username': username,
-        'semester': user['semester'],
-    }},
-                        upsert=True)
+    }, {
+        '$set': {
+            'username': username
+        },
+        '$setOnInsert': {
+            'semester': config.CURRENT_SEMESTER
+        },
+        '$unset': {
+            'blocked': ''
+        }
+    },
+                              upsert=True)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _ = await gettext_for(update)
     logging.info("User %s started the bot" % (update.effective_chat.id))
-    start_message = _("""
-    Hello! I'm a bot that can show you your timetable.
-    To get started, enter your group name after the command /group.
-    For example /group СУЛА-308С 
-    For more information, use the /help command.
-    """)
+    start_message = _(
+        "Hello! I'm a bot that can show you your timetable.\n"
+        "To get started, enter your group name after the command /group.\n"
+        "For example /group СУЛА-308С\n"
+        "For more information, use the /help command.")
     user_id = update.effective_chat.id
     username = update.effective_chat.username
-    if users_db.count_documents({'user_id': user_id}) == 0:
-        users_db.insert_one({
+    if await users_db.count_documents({'user_id': user_id}) == 0:
+        await users_db.insert_one({
             'user_id': user_id,
             'username': username,
-            'semester': 2
+            'semester': config.CURRENT_SEMESTER
         })
     await context.bot.send_message(chat_id=user_id, text=start_message)
 
 
 async def semester_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _ = await gettext_for(update)
     keyboard = [[
-        InlineKeyboardButton("Осенний семестр", callback_data=1),
-        InlineKeyboardButton("Весенний семестр", callback_data=2)
+        InlineKeyboardButton("Осенний семестр",
+                             callback_data=callback_data(SEMESTER_CALLBACK, 1)),
+        InlineKeyboardButton("Весенний семестр",
+                             callback_data=callback_data(SEMESTER_CALLBACK, 2))
     ]]
 
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -86,31 +165,72 @@ async def semester_choice(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def semester_choice_callback(update: Update,
                                    context: ContextTypes.DEFAULT_TYPE):
-    insert_or_update_user(update)
+    _ = await gettext_for(update)
+    await insert_or_update_user(update)
     query = update.callback_query
-    if query.message.text == _("Choose semester:"):
-        await query.answer()
-        logging.info("Selected semester: %s" % (query.data))
-        users_db.update_one({'user_id': update.effective_chat.id},
-                            {'$set': {
-                                'semester': int(query.data)
-                            }})
-        await query.edit_message_text(text=_("Semester successfully set "))
-    return
+    await query.answer()
+    semester = callback_payload(update)
+    logging.info("Selected semester: %s" % (semester))
+    await users_db.update_one({'user_id': update.effective_chat.id},
+                              {'$set': {
+                                  'semester': int(semester)
+                              }})
+    await query.edit_message_text(text=_("Semester successfully set"))
+
+
+async def load_search_indexes(recheck: bool = False) -> None:
+    """Builds the group and teacher name indexes once, or again with
+    `recheck` if the lists changed since"""
+    global _lists_version
+    if _lists_version is not None and not recheck:
+        return
+    version = await r.get(LISTS_VERSION_KEY) or b'0'
+    if version == _lists_version:
+        return
+    for collection, index, values, names in (
+        (groups_db, group_index, group_values, group_names),
+        (teachers_db, teacher_index, teacher_values, teacher_names)):
+        listed = {}
+        async for document in collection.find({}, {
+                '_id': 0,
+                'name': 1,
+                'value': 1,
+                'semester': 1
+        }):
+            # A name listed in several semesters keeps the current one's value
+            if (document['name'] not in listed
+                    or document.get('semester') == config.CURRENT_SEMESTER):
+                listed[document['name']] = document['value']
+        index.rebuild(listed)
+        values.clear()
+        values.update(listed)
+        names.clear()
+        names.update((value, name) for name, value in listed.items())
+    _lists_version = version
+    logging.info("Indexed %s groups and %s teachers" %
+                 (len(group_index), len(teacher_index)))
+
+
+async def refresh_search_indexes(context: ContextTypes.DEFAULT_TYPE):
+    """Rebuilds the name indexes when the lists were updated"""
+    await load_search_indexes(recheck=True)
 
 
 async def group_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Get group name from user and reply with timetable"""
-    insert_or_update_user(update)
+    _ = await gettext_for(update)
+    await insert_or_update_user(update)
     if len(context.args) == 0:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=_('Enter group name after command /group'))
         return
     if len(context.args) == 1:
-        group = context.args[0]
-        result = groups_db.find({'$text': {'$search': group}})
-        count = len(list(result.clone()))
+        await load_search_indexes()
+        group = group_index.get(context.args[0])
+        result = [group] if group else group_index.search(
+            context.args[0], config.SEARCH_LIMIT)
+        count = len(result)
         if count == 0:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
@@ -120,19 +240,21 @@ async def group_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             keyboad = []
             for group in result:
                 keyboad.append([
-                    InlineKeyboardButton(group['name'],
-                                         callback_data=group['name'])
+                    InlineKeyboardButton(group,
+                                         callback_data=callback_data(
+                                             GROUP_CALLBACK,
+                                             group_values[group]))
                 ])
             reply_markup = InlineKeyboardMarkup(keyboad)
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            text=_('Choose group:'),
                                            reply_markup=reply_markup)
             return
-        group = result[0]['name']
-        update_user(update.effective_chat.id, group)
+        group = result[0]
+        await update_user(update.effective_chat.id, group)
         await context.bot.send_message(chat_id=update.effective_chat.id,
-                                       text=_('Group successfully set to %s' %
-                                              (group)))
+                                       text=_('Group successfully set to %s') %
+                                       (group))
     else:
         await context.bot.send_message(chat_id=update.effective_chat.id,
                                        text=_('Too many arguments'))
@@ -140,27 +262,35 @@ async def group_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def group_input_callback(update: Update,
                                context: ContextTypes.DEFAULT_TYPE):
+    _ = await gettext_for(update)
     query = update.callback_query
-    if query.message.text == _("Choose group:"):
-        await query.answer()
-        group = query.data
-        update_user(update.effective_chat.id, group)
-        logging.info("Entered group: %s" % (group))
-        await query.edit_message_text(text=_('Group successfully set to %s' %
-                                             (group)))
+    await query.answer()
+    await load_search_indexes()
+    payload = callback_payload(update)
+    group = group_names.get(int(payload)) if payload.isdigit() else None
+    if group is None:
+        await query.edit_message_text(text=_('Group not found. Try again'))
+        return
+    await update_user(update.effective_chat.id, group)
+    logging.info("Entered group: %s" % (group))
+    await query.edit_message_text(text=_('Group successfully set to %s') %
+                                  (group))
 
 
 async def teacher_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    insert_or_update_user(update)
+    _ = await gettext_for(update)
+    await insert_or_update_user(update)
     if len(context.args) == 0:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=_('Enter teacher name after command /teacher'))
         return
     else:
-        teacher = ' '.join(context.args)
-        result = teachers_db.find({'$text': {'$search': teacher}})
-        count = len(list(result.clone()))
+        await load_search_indexes()
+        teacher = teacher_index.get(' '.join(context.args))
+        result = [teacher] if teacher else teacher_index.search(
+            ' '.join(context.args), config.SEARCH_LIMIT)
+        count = len(result)
         if count == 0:
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
@@ -170,39 +300,51 @@ async def teacher_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
             keyboad = []
             for teacher in result:
                 keyboad.append([
-                    InlineKeyboardButton(teacher['name'],
-                                         callback_data=teacher['name'])
+                    InlineKeyboardButton(teacher,
+                                         callback_data=callback_data(
+                                             TEACHER_CALLBACK,
+                                             teacher_values[teacher]))
                 ])
             reply_markup = InlineKeyboardMarkup(keyboad)
             await context.bot.send_message(chat_id=update.effective_chat.id,
                                            text=_('Choose teacher:'),
                                            reply_markup=reply_markup)
-        teacher = result[0]['name']
-        update_user(update.effective_chat.id, teacher=teacher)
+            return
+        teacher = result[0]
+        await update_user(update.effective_chat.id, teacher=teacher)
         logging.info("Entered teacher: %s" % (teacher))
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text=_('Teacher successfully set to %s' % (teacher)))
+            text=_('Teacher successfully set to %s') % (teacher))
         return
 
 
 async def teacher_input_callback(update: Update,
                                  context: ContextTypes.DEFAULT_TYPE):
+    _ = await gettext_for(update)
     query = update.callback_query
-    if query.message.text == _('Choose teacher:'):
-        await query.answer()
-        teacher = query.data
-        update_user(update.effective_chat.id, teacher=teacher)
-        logging.info("Entered teacher: %s" % (teacher))
-        await query.message.edit_text(text=_('Teacher successfully set to %s' %
-                                             (teacher)))
+    await query.answer()
+    await load_search_indexes()
+    payload = callback_payload(update)
+    teacher = teacher_names.get(int(payload)) if payload.isdigit() else None
+    if teacher is None:
+        await query.message.edit_text(text=_('No teacher found. Try again'))
+        return
+    await update_user(update.effective_chat.id, teacher=teacher)
+    logging.info("Entered teacher: %s" % (teacher))
+    await query.message.edit_text(text=_('Teacher successfully set to %s') %
+                                  (teacher))
 
 
 async def day_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    insert_or_update_user(update)
+    _ = await gettext_for(update)
+    await insert_or_update_user(update)
     keyboad = []
     for en_day, ru_day in DAYS.items():
-        keyboad.append([InlineKeyboardButton(en_day, callback_data=ru_day)])
+        keyboad.append(
+            [InlineKeyboardButton(_(en_day),
+                                  callback_data=callback_data(
+                                      DAY_CALLBACK, ru_day))])
     reply_markup = InlineKeyboardMarkup(keyboad)
     await context.bot.send_message(chat_id=update.effective_chat.id,
                                    text=_('Choose day:'),
@@ -211,82 +353,176 @@ async def day_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def day_input_callback(update: Update,
                              context: ContextTypes.DEFAULT_TYPE):
+    _ = await gettext_for(update)
     query = update.callback_query
-    if query.message.text == _('Choose day:'):
-        await query.answer()
-        day = query.data
-        logging.info("Entered day: %s" % (day))
-        try:
-            user = users_db.find_one({'user_id': update.effective_chat.id})
-            message = get_timetable(timetables_db=timetables_db,
-                                    redis_cache=r,
-                                    user=user,
-                                    day=day)
-            if len(message) > MessageLimit.MAX_TEXT_LENGTH:
-                await query.edit_message_text(text=_('Loading...'))
-                await send_message_by_chunks(context.bot,
-                                             update.effective_chat.id, message)
-            else:
-                await query.edit_message_text(text=message)
-            return
+    await query.answer()
+    day = callback_payload(update)
+    logging.info("Entered day: %s" % (day))
+    try:
+        user = await users_db.find_one({'user_id': update.effective_chat.id})
+        week = await get_ongoing_week(r, user['semester'])
+        message = await get_timetable(timetables_db=timetables_db,
+                                      cache=timetable_cache,
+                                      user=user,
+                                      day=day,
+                                      week=week)
+        if len(message) > MessageLimit.MAX_TEXT_LENGTH:
+            await query.edit_message_text(text=_('Loading...'))
+            await send_message_by_chunks(context.bot,
+                                         update.effective_chat.id, message)
+        else:
+            await query.edit_message_text(text=message)
+        return
 
-        except IndexError:
-            logging.info("No group or teacher found")
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=
-                _('You must set group or teacher before choosing day. Refer to /help'
-                  ))
-            return
-        except ValueError:
-            logging.info("No timetable found for %s" % (value))
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=_(f"I didn't find any timetable for {value}. Try again"))
-            return
-        except Exception as e:
-            logging.error(e)
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=_('Something went wrong. Try again'))
-            return
+    except IndexError:
+        logging.info("No group or teacher found")
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=
+            _('You must set group or teacher before choosing day. Refer to /help'
+              ))
+        return
+    except ValueError:
+        logging.info("No timetable found for %s" % (day))
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=_("I didn't find any timetable for %s. Try again") %
+            (day))
+        return
+    except Exception as e:
+        logging.error(e)
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text=_('Something went wrong. Try again'))
+        return
 
 
 async def send_daily_timetable(context: ContextTypes.DEFAULT_TYPE):
     day = DAYS[datetime.datetime.today().strftime('%A')]
-    week_message = get_ongoing_week()
-    users = users_db.find({
-        '$or': [{
-            'group': {
-                '$exists': True
+    # One entry per distinct timetable, so each message is rendered once
+    recipients = users_db.aggregate([{
+        '$match': {
+            '$or': [{
+                'group': {
+                    '$exists': True
+                }
+            }, {
+                "teacher": {
+                    '$exists': True
+                }
+            }],
+            'blocked': {
+                '$ne': True
             }
-        }, {
-            "teacher": {
-                '$exists': True
+        }
+    }, {
+        '$project': {
+            '_id': 0,
+            'user_id': 1,
+            'group': 1,
+            'teacher': 1,
+            'semester': 1
+        }
+    }, {
+        '$group': {
+            '_id': {
+                'group': '$group',
+                'teacher': '$teacher',
+                'semester': '$semester'
+            },
+            'user_ids': {
+                '$push': '$user_id'
             }
-        }]
-    })
-    for user in users:
-        user_id = user['user_id']
-        message = get_timetable(timetables_db=timetables_db,
-                                redis_cache=r,
-                                user=user,
-                                day=day)
-        message = f"{week_message}\nРасписание дня\n{message}"
-        if len(message) > MessageLimit.MAX_TEXT_LENGTH:
-            await send_message_by_chunks(context.bot, user_id, message)
-        else:
-            await context.bot.send_message(chat_id=user_id, text=message)
+        }
+    }])
+    messages = []
+    timetables = 0
+    async for entity in recipients:
+        try:
+            week = await get_ongoing_week(r, entity['_id']['semester'])
+            message = await get_timetable(timetables_db=timetables_db,
+                                          cache=timetable_cache,
+                                          user=entity['_id'],
+                                          day=day,
+                                          week=week)
+        except Exception as e:
+            logging.error("No timetable for %s: %s" % (entity['_id'], e))
+            continue
+        timetables += 1
+        message = f"Расписание дня\n{message}"
+        if week is not None:
+            message = f"Текущая неделя: {week}\n{message}"
+        messages.extend((user_id, message) for user_id in entity['user_ids'])
+    logging.info("Sending %s timetables to %s users" %
+                 (timetables, len(messages)))
+    logging.info("Timetable cache stats: %s" % (timetable_cache.stats()))
+    report = await Broadcaster(context.bot).broadcast(messages)
+    await mark_blocked_users(report.blocked)
+
+
+async def mark_blocked_users(user_ids: List[int]) -> None:
+    """Excludes users who blocked the bot from later broadcasts"""
+    if user_ids:
+        await users_db.update_many({'user_id': {
+            '$in': user_ids
+        }}, {'$set': {
+            'blocked': True
+        }})
+
+
+async def notify_timetable_changes(context: ContextTypes.DEFAULT_TYPE):
+    """Tells subscribed users how their timetable changed after a refresh"""
+    async with r.pipeline(transaction=True) as pipe:
+        pipe.lrange(CHANGES_KEY, 0, config.NOTIFY_BATCH_SIZE - 1)
+        pipe.ltrim(CHANGES_KEY, config.NOTIFY_BATCH_SIZE, -1)
+        notices, _ = await pipe.execute()
+    if not notices:
+        return
+    messages = []
+    for notice in map(json.loads, notices):
+        diff = notice.pop('diff')
+        semester = notice.pop('semester', config.CURRENT_SEMESTER)
+        (field, name), = notice.items()
+        message = f"Расписание {name} изменилось:\n{diff}"
+        users = users_db.find({
+            field: name,
+            'semester': semester,
+            'blocked': {
+                '$ne': True
+            }
+        }, {
+            '_id': 0,
+            'user_id': 1
+        })
+        async for user in users:
+            messages.append((user['user_id'], message))
+    logging.info("Notifying %s users of %s timetable changes" %
+                 (len(messages), len(notices)))
+    report = await Broadcaster(context.bot).broadcast(messages)
+    await mark_blocked_users(report.blocked)
 
 
 async def language(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Translate the bot's messages to the user's language.
     """
+    _ = await gettext_for(update)
     language_keyboad = [
-        [InlineKeyboardButton(_("English"), callback_data="en")],
-        [InlineKeyboardButton(_("Russian"), callback_data="ru")],
-        [InlineKeyboardButton(_("French"), callback_data="fr")],
+        [
+            InlineKeyboardButton(_("English"),
+                                 callback_data=callback_data(
+                                     LANGUAGE_CALLBACK, "en"))
+        ],
+        [
+            InlineKeyboardButton(_("Russian"),
+                                 callback_data=callback_data(
+                                     LANGUAGE_CALLBACK, "ru"))
+        ],
+        [
+            InlineKeyboardButton(_("French"),
+                                 callback_data=callback_data(
+                                     LANGUAGE_CALLBACK, "fr"))
+        ],
     ]
     language_keyboad_markup = InlineKeyboardMarkup(language_keyboad)
     await context.bot.send_message(
@@ -301,35 +537,146 @@ async def language_choice_callback(update: Update,
     """
     Handle the user's choice of language.
     """
-    global translator
     query = update.callback_query
-    if query.message.text == _("Choose your language:"):
+    await query.answer()
+    language = callback_payload(update)
+    if language not in i18n.LANGUAGES:
+        return
+    # Creates the user with a semester if /language is their first command
+    await insert_or_update_user(update)
+    user_id = update.effective_chat.id
+    await users_db.update_one({'user_id': user_id},
+                              {'$set': {
+                                  'language': language
+                              }})
+    user_languages.set(user_id, language)
+    logging.info("Language set to: %s" % (language))
+    _ = functools.partial(i18n.gettext, language=language)
+    await query.message.edit_text(text=_("Language set"))
+
+
+CALLBACK_HANDLERS = {
+    SEMESTER_CALLBACK: semester_choice_callback,
+    GROUP_CALLBACK: group_input_callback,
+    TEACHER_CALLBACK: teacher_input_callback,
+    DAY_CALLBACK: day_input_callback,
+    LANGUAGE_CALLBACK: language_choice_callback,
+}
+
+
+async def callback_dispatcher(update: Update,
+                              context: ContextTypes.DEFAULT_TYPE):
+    """
+    Route a button press to exactly one handler by its callback data prefix.
+    """
+    query = update.callback_query
+    prefix = query.data.partition(':')[0]
+    handler = CALLBACK_HANDLERS.get(prefix)
+    if handler is None:
+        # Buttons sent before callback data was namespaced
+        logging.warning("Unknown callback data: %s" % (query.data))
         await query.answer()
-        language = query.data
-        if len(language) != 2:
-            return
-        translator = Translator(to_lang=language)
-        logging.info("Language set to: %s" % (language))
-        await query.message.edit_text(text=_("Language set "))
+        return
+    await handler(update, context)
+
+
+async def load_ongoing_weeks(context: ContextTypes.DEFAULT_TYPE):
+    """Loads the week calibrations at startup, so inline answers read the
+    same week keys as the warmed cache before anyone asked for /day"""
+    await load_week_calibrations(r)
+
+
+async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Suggests the groups and teachers matching an inline query, each
+    with its timetable of the day.
+
+    Answers come from the name indexes and the message cache only, so
+    every keystroke is answered without reaching Mongo or ISU. Timetables
+    are of the current semester, and of Monday on Sundays.
+    """
+    query = update.inline_query
+    language = user_languages.get(query.from_user.id)
+    if language is None:
+        language = (query.from_user.language_code
+                    if query.from_user.language_code in i18n.LANGUAGES else
+                    i18n.SOURCE_LANGUAGE)
+    _ = functools.partial(i18n.gettext, language=language)
+    names = [
+        *group_index.search(query.query, config.INLINE_LIMIT),
+        *teacher_index.search(query.query, config.INLINE_LIMIT)
+    ]
+    if not names:
+        await query.answer([], cache_time=config.INLINE_CACHE_TIME)
+        return
+    date = datetime.date.today()
+    if date.weekday() == 6:
+        date += datetime.timedelta(days=1)
+    weekday = date.strftime('%A')
+    semester = config.CURRENT_SEMESTER
+    week = known_ongoing_week(semester, date)
+    generation = await timetable_cache.generation()
+    keys = [
+        timetable_key(name, semester, DAYS[weekday], generation, week)
+        for name in names
+    ]
+    messages = await timetable_cache.get_many(keys)
+    results = []
+    for i, (name, key) in enumerate(zip(names, keys)):
+        message = messages[key] or _("Timetable of %s isn't available yet,"
+                                     " try /day") % (name)
+        results.append(
+            InlineQueryResultArticle(
+                id=str(i),
+                title=name,
+                description=_(weekday),
+                input_message_content=InputTextMessageContent(
+                    f"{name}\n{message}"[:MessageLimit.MAX_TEXT_LENGTH])))
+    await query.answer(results, cache_time=config.INLINE_CACHE_TIME)
+
+
+async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Tells when the timetables were last refreshed and how it went"""
+    _ = await gettext_for(update)
+    await insert_or_update_user(update)
+    last_run = await r.get(LAST_RUN_KEY)
+    if last_run is None:
+        text = _("Timetables haven't been refreshed yet")
+    else:
+        last_run = json.loads(last_run)
+        lines = [
+            _("Timetables last refreshed: %s") % (last_run['finished_at']),
+            _("Changed timetables: %s of %s") %
+            (last_run['changed'], last_run['checked']),
+        ]
+        lines.extend(f"{stage}: {seconds}s"
+                     for stage, seconds in last_run['stages'].items())
+        text = '\n'.join(lines)
+    await context.bot.send_message(chat_id=update.effective_chat.id,
+                                   text=text)
 
 
 async def help(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    insert_or_update_user(update)
+    _ = await gettext_for(update)
+    await insert_or_update_user(update)
     command_list = [
-        '/start - Start the bot',
-        '/semester - Choose semester',
-        '/group - Enter group name after command e.g. /group СУЛА-2',
-        '/teacher - Enter teacher\'s name after command e.g. /teacher Иванов',
-        '/day - Get timetable for a day',
-        '/language - Choose language. For a smooth experience, choose English',
-        '/help - Show this message',
+        N_('/start - Start the bot'),
+        N_('/semester - Choose semester'),
+        N_('/group - Enter group name after command e.g. /group СУЛА-2'),
+        N_('/teacher - Enter teacher\'s name after command e.g. /teacher Иванов'
+           ),
+        N_('/day - Get timetable for a day'),
+        N_('/language - Choose language. For a smooth experience, choose English'
+           ),
+        N_('/status - Show when timetables were last refreshed'),
+        N_('/help - Show this message'),
     ]
     await context.bot.send_message(chat_id=update.effective_chat.id,
-                                   text=_('\n'.join(command_list)))
+                                   text='\n'.join(
+                                       _(command) for command in command_list))
 
 
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
-
+    _ = await gettext_for(update)
     if update.message.text.startswith('/'):
         logging.warning("Unknown command : %s" % (update.message.text))
         await context.bot.send_message(
@@ -345,6 +692,7 @@ async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def maintenance(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    _ = await gettext_for(update)
     logging.info("Got interapted by %s" % (update.effective_chat.id))
     await context.bot.send_message(chat_id=update.effective_chat.id,
                                    text=_("I'll be back soon.Keep in touch!"))
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Tuple
+
+from telegram import Bot
+from telegram.constants import MessageLimit
+from telegram.error import (
+    BadRequest,
+    Forbidden,
+    NetworkError,
+    RetryAfter,
+    TelegramError,
+)
+
+import config
+
+DELIVERED = 'delivered'
+FAILED = 'failed'
+BLOCKED = 'blocked'
+
+
+@dataclass
+class BroadcastReport:
+    delivered: int = 0
+    failed: int = 0
+    blocked: List[int] = field(default_factory=list)
+    seconds: float = 0
+
+
+class RateLimiter:
+    """Spaces acquisitions out to at most `rate` per second"""
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Holds every caller back, e.g. after Telegram asked us to wait"""
+        self._next = max(self._next, time.monotonic() + seconds)
+
+
+class Broadcaster:
+    """Sends messages to many chats within Telegram's flood limits.
+
+    At most `concurrency` chats are served at once, all of them sharing a
+    global budget of `rate` messages per second, and consecutive messages
+    to one chat are `1 / per_chat_rate` seconds apart. 429 responses pause
+    every sender for the requested time; network errors are retried with
+    exponential backoff up to `max_retries` times.
+    """
+
+    def __init__(self,
+                 bot: Bot,
+                 concurrency: int = config.BROADCAST_CONCURRENCY,
+                 rate: float = config.BROADCAST_RATE,
+                 per_chat_rate: float = config.BROADCAST_PER_CHAT_RATE,
+                 max_retries: int = config.BROADCAST_MAX_RETRIES):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.per_chat_interval = 1 / per_chat_rate
+        self.max_retries = max_retries
+        self._last_sent: Dict[int, float] = {}
+
+    async def _send_chunk(self, chat_id: int, text: str) -> None:
+        last_sent = self._last_sent.get(chat_id)
+        if last_sent is not None:
+            wait = last_sent + self.per_chat_interval - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        await self.limiter.acquire()
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text)
+        finally:
+            self._last_sent[chat_id] = time.monotonic()
+
+    async def send(self, chat_id: int, text: str) -> str:
+        """Sends text to a chat, split into chunks if it's too long"""
+        chunk_size = MessageLimit.MAX_TEXT_LENGTH
+        for i in range(0, len(text), chunk_size):
+            chunk = text[i:i + chunk_size]
+            attempt = 0
+            while True:
+                try:
+                    await self._send_chunk(chat_id, chunk)
+                    break
+                except RetryAfter as e:
+                    logging.warning("Flood limit hit, waiting %ss" %
+                                    (e.retry_after))
+                    self.limiter.pause(e.retry_after)
+                except Forbidden:
+                    return BLOCKED
+                except BadRequest as e:
+                    logging.warning("Could not send to %s: %s" %
+                                    (chat_id, e))
+                    return FAILED
+                except NetworkError as e:
+                    logging.warning("Network error sending to %s: %s" %
+                                    (chat_id, e))
+                    await asyncio.sleep(2**attempt)
+                except TelegramError as e:
+                    logging.warning("Could not send to %s: %s" %
+                                    (chat_id, e))
+                    return FAILED
+                attempt += 1
+                if attempt > self.max_retries:
+                    return FAILED
+        return DELIVERED
+
+    async def broadcast(self,
+                        messages: Iterable[Tuple[int, str]]) -> BroadcastReport:
+        """Sends each (chat_id, text) pair and reports how it went"""
+        started = time.perf_counter()
+        report = BroadcastReport()
+        messages = iter(messages)
+
+        async def worker():
+            for chat_id, text in messages:
+                status = await self.send(chat_id, text)
+                if status == DELIVERED:
+                    report.delivered += 1
+                elif status == BLOCKED:
+                    report.blocked.append(chat_id)
+                else:
+                    report.failed += 1
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        self._last_sent.clear()
+        report.seconds = round(time.perf_counter() - started, 3)
+        logging.info(
+            "Broadcast done in %ss: %s delivered, %s failed, %s blocked" %
+            (report.seconds, report.delivered, report.failed,
+             len(report.blocked)))
+        return report
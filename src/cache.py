@@ -0,0 +1,193 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+import redis.asyncio
+
+
+# Bumped after every timetable refresh; keys of older generations are
+# never read again and expire by TTL instead of being flushed
+GENERATION_KEY = 'timetables:generation'
+
+
+def timetable_key(name: str,
+                  semester: int,
+                  day: str,
+                  generation: int,
+                  week: Optional[int] = None) -> str:
+    """Returns the cache key of a group's or teacher's message for a day"""
+    name = "".join(name.lower().split())
+    key = f'timetable:{generation}:{name}_{semester}_{day.lower()}'
+    if week is not None:
+        key += f'_w{week}'
+    return key
+
+
+class LRUCache:
+    """A bounded in-process mapping evicting the least recently used keys.
+
+    With a `ttl`, entries also expire that many seconds after being set.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            value, expires_at = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        expires_at = None
+        if self.ttl is not None:
+            expires_at = time.monotonic() + self.ttl
+        self._data[key] = (value, expires_at)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+
+class TwoTierCache:
+    """Rendered messages kept in a local LRU in front of Redis.
+
+    Reads try the process first and only go to Redis on a local miss;
+    writes go to both tiers so a refresh invalidates them together. Redis
+    entries expire after `ttl` seconds, and the current cache generation
+    is re-read from Redis at most every `generation_interval` seconds.
+    """
+
+    def __init__(self,
+                 redis_cache: redis.asyncio.Redis,
+                 local: LRUCache,
+                 ttl: Optional[int] = None,
+                 generation_interval: float = 30):
+        self.redis = redis_cache
+        self.local = local
+        self.ttl = ttl
+        self.generation_interval = generation_interval
+        self.redis_hits = 0
+        self.redis_misses = 0
+        self._generation = 0
+        self._generation_checked_at = None
+
+    async def generation(self) -> int:
+        now = time.monotonic()
+        if (self._generation_checked_at is None or
+                now - self._generation_checked_at >= self.generation_interval):
+            generation = await self.redis.get(GENERATION_KEY)
+            self._generation = int(generation or 0)
+            self._generation_checked_at = now
+        return self._generation
+
+    async def get(self, key: str) -> Optional[str]:
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        cached = await self.redis.get(key)
+        if cached is None:
+            self.redis_misses += 1
+            return None
+        self.redis_hits += 1
+        value = cached.decode('utf-8')
+        self.local.set(key, value)
+        return value
+
+    async def get_many(self, keys: List[str]) -> Dict[str, Optional[str]]:
+        """Gets several keys, with a single MGET for the local misses"""
+        values = {key: self.local.get(key) for key in keys}
+        missing = [key for key, value in values.items() if value is None]
+        if missing:
+            for key, cached in zip(missing, await self.redis.mget(missing)):
+                if cached is None:
+                    self.redis_misses += 1
+                    continue
+                self.redis_hits += 1
+                values[key] = cached.decode('utf-8')
+                self.local.set(key, values[key])
+        return values
+
+    async def set(self, key: str, value: str) -> None:
+        await self.redis.set(key, value, ex=self.ttl)
+        self.local.set(key, value)
+
+    async def set_many(self, items: Dict[str, str]) -> None:
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key, value in items.items():
+                pipe.set(key, value, ex=self.ttl)
+            await pipe.execute()
+        for key, value in items.items():
+            self.local.set(key, value)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'local_hits': self.local.hits,
+            'local_misses': self.local.misses,
+            'local_size': len(self.local),
+            'redis_hits': self.redis_hits,
+            'redis_misses': self.redis_misses,
+        }
+
+
+class SingleFlight:
+    """Runs at most one loader per key, sharing its result with every caller"""
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    async def run(self, key: Hashable, loader: Callable[[], Awaitable[Any]]):
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(loader())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # A cancelled caller must not cancel the load the others wait for
+        return await asyncio.shield(future)
+
+
+async def cache_aside(cache: TwoTierCache, key: str,
+                      loader: Callable[[], Awaitable[str]],
+                      flight: SingleFlight) -> str:
+    """Returns the cached value of key, building it once on a miss.
+
+    A hit costs at most a single GET. On a miss only one caller per key
+    runs `loader` and stores its result; concurrent callers wait for it.
+    """
+    cached = await cache.get(key)
+    if cached is not None:
+        logging.info("Got %s from cache" % (key))
+        return cached
+
+    async def load() -> str:
+        value = await loader()
+        await cache.set(key, value)
+        logging.info("Saved %s to cache" % (key))
+        return value
+
+    return await flight.run(key, load)
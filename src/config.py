@@ -1,3 +1,4 @@
+import datetime
 import os
 from pathlib import Path
 
@@ -8,6 +9,13 @@ load_dotenv(BASE_DIR / '.env')
 
 # GENERAL
 ACADEMIC_YEAR = "2022/2023"
+CURRENT_SEMESTER = int(os.getenv('CURRENT_SEMESTER', 2))
+# ISO dates of the Monday of week 1, used until ISU has been asked once
+SEMESTER_START_DATES = {
+    semester: datetime.date.fromisoformat(os.getenv(name))
+    for semester, name in ((1, 'AUTUMN_SEMESTER_START'),
+                           (2, 'SPRING_SEMESTER_START')) if os.getenv(name)
+}
 DEBUG = bool(int(os.getenv('DEBUG')))
 MAINTENANCE = bool(int(os.getenv('MAINTENANCE')))
 # Telegram
@@ -17,15 +25,91 @@ SECRET_KEY = os.getenv('SECRET_KEY')
 # Database
 MONGO_URI = os.getenv('MONGO_URI')
 MONGO_DB_NAME = os.getenv('MONGO_DB_NAME')
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 50))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', 0))
+BULK_WRITE_BATCH_SIZE = int(os.getenv('BULK_WRITE_BATCH_SIZE', 500))
+# Entities scraped per refresh subtask, and how long (seconds) an
+# interrupted refresh can be resumed
+REFRESH_SHARD_SIZE = int(os.getenv('REFRESH_SHARD_SIZE', 50))
+REFRESH_LEDGER_TTL = int(os.getenv('REFRESH_LEDGER_TTL', 24 * 60 * 60))
+# Longest a refresh pipeline can hold its lock, in seconds
+PIPELINE_LOCK_TIMEOUT = int(os.getenv('PIPELINE_LOCK_TIMEOUT', 4 * 60 * 60))
+# Derive teacher and room timetables from the group ones instead of
+# scraping teacher pages. The headers are those of the teacher and room
+# columns on group pages and of the groups column on teacher pages; the
+# spot checks are teacher pages still scraped per semester to compare
+DERIVE_TIMETABLES = bool(int(os.getenv('DERIVE_TIMETABLES', 0)))
+DERIVE_TEACHER_HEADER = os.getenv('DERIVE_TEACHER_HEADER', 'Преподаватель')
+DERIVE_ROOM_HEADER = os.getenv('DERIVE_ROOM_HEADER', 'Аудитория')
+DERIVE_GROUP_HEADER = os.getenv('DERIVE_GROUP_HEADER', 'Группа')
+DERIVE_SPOT_CHECKS = int(os.getenv('DERIVE_SPOT_CHECKS', 5))
 
 # Redis
 REDIS_HOST = os.getenv('REDIS_HOST')
 REDIS_PORT = os.getenv('REDIS_PORT')
 REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', 50))
+# Rendered timetables expire from Redis after CACHE_TTL seconds, which must
+# outlive a refresh cycle so the previous generation is still there to serve
+CACHE_TTL = int(os.getenv('CACHE_TTL', 12 * 60 * 60))
+CACHE_GENERATION_INTERVAL = int(os.getenv('CACHE_GENERATION_INTERVAL', 30))
+CACHE_WARM_BATCH_SIZE = int(os.getenv('CACHE_WARM_BATCH_SIZE', 500))
+CACHE_WARM_FULL_WEEK = bool(int(os.getenv('CACHE_WARM_FULL_WEEK', 0)))
+# In-process tier in front of Redis for rendered timetables
+LOCAL_CACHE_SIZE = int(os.getenv('LOCAL_CACHE_SIZE', 5000))
+LOCAL_CACHE_TTL = int(os.getenv('LOCAL_CACHE_TTL', 300))
 
 # Celery
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL')
 
+# Search
+# Buttons offered for an ambiguous /group or /teacher, the least trigram
+# similarity of a fuzzy match, and how often (seconds) the bot checks if
+# the lists changed
+SEARCH_LIMIT = int(os.getenv('SEARCH_LIMIT', 10))
+SEARCH_MIN_SIMILARITY = float(os.getenv('SEARCH_MIN_SIMILARITY', 0.3))
+SEARCH_INDEX_INTERVAL = int(os.getenv('SEARCH_INDEX_INTERVAL', 300))
+# Groups and teachers each suggested to an inline query, and how long
+# (seconds) Telegram may reuse an answer
+INLINE_LIMIT = int(os.getenv('INLINE_LIMIT', 10))
+INLINE_CACHE_TIME = int(os.getenv('INLINE_CACHE_TIME', 300))
+
+# Broadcast
+# Telegram allows about 30 messages per second overall and 1 per chat
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', 20))
+BROADCAST_RATE = float(os.getenv('BROADCAST_RATE', 25))
+BROADCAST_PER_CHAT_RATE = float(os.getenv('BROADCAST_PER_CHAT_RATE', 1))
+BROADCAST_MAX_RETRIES = int(os.getenv('BROADCAST_MAX_RETRIES', 3))
+# How often (seconds) and how many timetable changes are sent to subscribers
+NOTIFY_INTERVAL = int(os.getenv('NOTIFY_INTERVAL', 60))
+NOTIFY_BATCH_SIZE = int(os.getenv('NOTIFY_BATCH_SIZE', 100))
+
+# ISU
+# Consecutive failed scrapes before refreshes pause, and for how many seconds
+ISU_FAILURE_THRESHOLD = int(os.getenv('ISU_FAILURE_THRESHOLD', 3))
+ISU_RETRY_AFTER = int(os.getenv('ISU_RETRY_AFTER', 300))
+# HTTP client used to scrape ISU: seconds before a request times out, pooled
+# connections, requests in flight per host and retries of a failed request
+ISU_TIMEOUT = float(os.getenv('ISU_TIMEOUT', 20))
+ISU_MAX_CONNECTIONS = int(os.getenv('ISU_MAX_CONNECTIONS', 20))
+ISU_PER_HOST_CONCURRENCY = int(os.getenv('ISU_PER_HOST_CONCURRENCY', 10))
+ISU_MAX_RETRIES = int(os.getenv('ISU_MAX_RETRIES', 3))
+ISU_RETRY_BACKOFF = float(os.getenv('ISU_RETRY_BACKOFF', 1))
+# HTTP/2 is only used when the h2 package is installed
+ISU_HTTP2 = bool(int(os.getenv('ISU_HTTP2', 1)))
+# Refresh pipeline: pages downloaded at once, pages waiting to be parsed
+# and processes parsing them
+SCRAPE_FETCH_WORKERS = int(os.getenv('SCRAPE_FETCH_WORKERS', 20))
+SCRAPE_QUEUE_SIZE = int(os.getenv('SCRAPE_QUEUE_SIZE', 100))
+SCRAPE_PARSE_WORKERS = int(
+    os.getenv('SCRAPE_PARSE_WORKERS', os.cpu_count() or 1))
+# Seconds a page may take to parse before it is given up on
+SCRAPE_PARSE_TIMEOUT = float(os.getenv('SCRAPE_PARSE_TIMEOUT', 30))
+# Keep the raw pages fetched from ISU in GridFS to rebuild the timetables
+# offline, and seconds an unreferenced page is kept before being pruned
+SNAPSHOTS = bool(int(os.getenv('SNAPSHOTS', 0)))
+SNAPSHOT_PRUNE_GRACE = int(os.getenv('SNAPSHOT_PRUNE_GRACE', 24 * 60 * 60))
+
 # Browserstack
 BROWSERSTACK_USERNAME = os.getenv('BROWSERSTACK_USERNAME')
 BROWSERSTACK_ACCESS_KEY = os.getenv('BROWSERSTACK_ACCESS_KEY')
@@ -1,13 +1,48 @@
+import logging
+import os
+import time
+from typing import Dict, Iterable, List
+
+import motor.motor_asyncio
 import pymongo
 import redis
+import redis.asyncio
 
 import config
 
+# One pooled client of each kind per process, created on first use. Clients
+# inherited through fork (e.g. Celery prefork workers) are dropped in the
+# child so it opens its own connections instead of sharing the parent's.
+_mongo_client = None
+_redis_pool = None
+_async_mongo_client = None
+_async_redis = None
+
+
+def _reset_clients() -> None:
+    global _mongo_client, _redis_pool, _async_mongo_client, _async_redis
+    _mongo_client = None
+    _redis_pool = None
+    _async_mongo_client = None
+    _async_redis = None
+
+
+os.register_at_fork(after_in_child=_reset_clients)
+
+
+def get_mongo_client() -> pymongo.MongoClient:
+    global _mongo_client
+    if _mongo_client is None:
+        _mongo_client = pymongo.MongoClient(
+            config.MONGO_URI,
+            maxPoolSize=config.MONGO_MAX_POOL_SIZE,
+            minPoolSize=config.MONGO_MIN_POOL_SIZE,
+            connect=False)
+    return _mongo_client
+
 
 def get_db() -> pymongo.database.Database:
-    client = pymongo.MongoClient(config.MONGO_URI)
-    db = client[config.MONGO_DB_NAME]
-    return db
+    return get_mongo_client()[config.MONGO_DB_NAME]
 
 
 def get_users_collection() -> pymongo.collection.Collection:
@@ -17,22 +52,12 @@ def get_users_collection() -> pymongo.collection.Collection:
 
 def get_groups_collection() -> pymongo.collection.Collection:
     db = get_db()
-    groups = db.groups
-    if 'name_text' not in groups.index_information():
-        groups.create_index([('name', 'text')],
-                            unique=False,
-                            default_language='russian')
-    return groups
+    return db.groups
 
 
 def get_teachers_collection() -> pymongo.collection.Collection:
     db = get_db()
-    teachers = db.teachers
-    if 'name_text' not in teachers.index_information():
-        teachers.create_index([('name', 'text')],
-                              unique=False,
-                              default_language='russian')
-    return teachers
+    return db.teachers
 
 
 def get_timetables_collection() -> pymongo.collection.Collection:
@@ -41,9 +66,139 @@ def get_timetables_collection() -> pymongo.collection.Collection:
 
 
 def get_redis_connection() -> redis.Redis:
-    return redis.Redis(host=config.REDIS_HOST,
-                       port=config.REDIS_PORT,
-                       password=config.REDIS_PASSWORD)
+    global _redis_pool
+    if _redis_pool is None:
+        _redis_pool = redis.ConnectionPool(
+            host=config.REDIS_HOST,
+            port=config.REDIS_PORT,
+            password=config.REDIS_PASSWORD,
+            max_connections=config.REDIS_MAX_CONNECTIONS)
+    return redis.Redis(connection_pool=_redis_pool)
+
+
+def ensure_indexes() -> None:
+    """Creates the indexes the bot relies on; run once at startup"""
+    db = get_db()
+    for collection in (db.groups, db.teachers):
+        collection.create_index([('name', 'text')],
+                                unique=False,
+                                default_language='russian')
+    # Subscribers of a changed timetable are looked up by entity
+    db.users.create_index('group')
+    db.users.create_index('teacher')
+    # Timetables are stored per semester; older documents were all of the
+    # configured one
+    db.timetables.update_many({'semester': {
+        '$exists': False
+    }}, {'$set': {
+        'semester': config.CURRENT_SEMESTER
+    }})
+    db.timetables.create_index([('group', 1), ('semester', 1)])
+    db.timetables.create_index([('teacher', 1), ('semester', 1)])
+    db.snapshot_refs.create_index([('semester', 1), ('what_show', 1),
+                                   ('value', 1)],
+                                  unique=True)
+    db.snapshot_refs.create_index('digest')
+    logging.info("Database indexes are in place")
+
+
+def bulk_write_in_batches(
+        collection: pymongo.collection.Collection,
+        operations: Iterable,
+        batch_size: int = config.BULK_WRITE_BATCH_SIZE) -> Dict[str, int]:
+    """Sends operations as unordered bulk writes of batch_size each.
+
+    Operations may be a generator; batches are flushed as they fill up.
+    Returns the matched, upserted and modified counts of all batches.
+    """
+    totals = {'matched': 0, 'upserted': 0, 'modified': 0}
+    batch = []
+    for operation in operations:
+        batch.append(operation)
+        if len(batch) >= batch_size:
+            _flush_bulk_write(collection, batch, totals)
+            batch = []
+    if batch:
+        _flush_bulk_write(collection, batch, totals)
+    return totals
+
+
+def _flush_bulk_write(collection: pymongo.collection.Collection,
+                      batch: List, totals: Dict[str, int]) -> None:
+    started = time.perf_counter()
+    result = collection.bulk_write(batch, ordered=False)
+    totals['matched'] += result.matched_count
+    totals['upserted'] += result.upserted_count
+    totals['modified'] += result.modified_count
+    logging.info(
+        "Wrote %s operations to %s in %.3fs: %s matched, %s upserted, "
+        "%s modified" %
+        (len(batch), collection.name, time.perf_counter() - started,
+         result.matched_count, result.upserted_count, result.modified_count))
+
+
+def close_connections() -> None:
+    """Closes the process' synchronous clients"""
+    global _mongo_client, _redis_pool
+    if _mongo_client is not None:
+        _mongo_client.close()
+        _mongo_client = None
+    if _redis_pool is not None:
+        _redis_pool.disconnect()
+        _redis_pool = None
+
+
+def get_async_db() -> motor.motor_asyncio.AsyncIOMotorDatabase:
+    global _async_mongo_client
+    if _async_mongo_client is None:
+        _async_mongo_client = motor.motor_asyncio.AsyncIOMotorClient(
+            config.MONGO_URI,
+            maxPoolSize=config.MONGO_MAX_POOL_SIZE,
+            minPoolSize=config.MONGO_MIN_POOL_SIZE)
+    return _async_mongo_client[config.MONGO_DB_NAME]
+
+
+def get_async_users_collection(
+) -> motor.motor_asyncio.AsyncIOMotorCollection:
+    return get_async_db().users
+
+
+def get_async_groups_collection(
+) -> motor.motor_asyncio.AsyncIOMotorCollection:
+    return get_async_db().groups
+
+
+def get_async_teachers_collection(
+) -> motor.motor_asyncio.AsyncIOMotorCollection:
+    return get_async_db().teachers
+
+
+def get_async_timetables_collection(
+) -> motor.motor_asyncio.AsyncIOMotorCollection:
+    return get_async_db().timetables
+
+
+def get_async_redis_connection() -> redis.asyncio.Redis:
+    global _async_redis
+    if _async_redis is None:
+        pool = redis.asyncio.ConnectionPool(
+            host=config.REDIS_HOST,
+            port=config.REDIS_PORT,
+            password=config.REDIS_PASSWORD,
+            max_connections=config.REDIS_MAX_CONNECTIONS)
+        _async_redis = redis.asyncio.Redis(connection_pool=pool)
+    return _async_redis
+
+
+async def close_async_connections() -> None:
+    """Closes the process' asynchronous clients"""
+    global _async_mongo_client, _async_redis
+    if _async_mongo_client is not None:
+        _async_mongo_client.close()
+        _async_mongo_client = None
+    if _async_redis is not None:
+        await _async_redis.close(close_connection_pool=True)
+        _async_redis = None
 
 
 if __name__ == '__main__':
@@ -0,0 +1,90 @@
+import re
+from typing import Dict, Iterable, List, Set, Tuple
+
+
+def name_key(name: str) -> str:
+    """Reduces a name to its first word and initials, so "Иванов Иван
+    Иванович" and "Иванов И.И." compare equal"""
+    words = re.findall(r'\w+', name.lower())
+    if not words:
+        return ''
+    return ' '.join([words[0], *(word[0] for word in words[1:])])
+
+
+def _split_values(value: str) -> List[str]:
+    return [part.strip() for part in re.split(r'[,;\n]', value) if part.strip()]
+
+
+def invert_timetables(timetables: Dict[str, Dict], header: str,
+                      group_header: str) -> Dict[str, Dict]:
+    """Builds the timetables of the values of a column, e.g. the teachers,
+    from the timetables of the groups.
+
+    Each lesson is listed for every value of its `header` cell, with that
+    column replaced by a `group_header` one naming the groups attending
+    it, so a lesson shared by several groups is listed once. Lessons keep
+    their slot in the day, hence their order.
+    """
+    days = []
+    slots: Dict[str, Dict[str, Dict[int, Dict[Tuple, Dict]]]] = {}
+    for group, timetable in timetables.items():
+        for day, cells in timetable.items():
+            if day not in days:
+                days.append(day)
+            for position, cell in enumerate(cells):
+                if not cell.get(header):
+                    continue
+                lesson = {
+                    column: value
+                    for column, value in cell.items() if column != header
+                }
+                key = tuple(sorted(lesson.items()))
+                for value in _split_values(cell[header]):
+                    slot = slots.setdefault(value, {}).setdefault(
+                        day, {}).setdefault(position, {})
+                    if key not in slot:
+                        slot[key] = {**lesson, group_header: group}
+                    elif group not in slot[key][group_header].split(', '):
+                        slot[key][group_header] += ', ' + group
+    return {
+        value: {
+            day: [
+                cell for position in sorted(value_days.get(day, {}))
+                for cell in value_days[day][position].values()
+            ]
+            for day in days
+        }
+        for value, value_days in slots.items()
+    }
+
+
+def _lessons(timetable: Dict, day: str, columns: List[str],
+             group_header: str) -> Set[Tuple]:
+    return {
+        tuple(cell.get(column, '') for column in columns)
+        for cell in timetable.get(day, []) if cell.get(group_header)
+    }
+
+
+def same_lessons(derived: Dict, scraped: Dict, group_header: str,
+                 ignore: Iterable[str] = ()) -> bool:
+    """Tells if a derived timetable has the lessons of the scraped one.
+
+    Only lessons with groups are compared, on the columns both timetables
+    have except the groups one and `ignore`, whose values may be written
+    differently.
+    """
+
+    def columns(timetable: Dict) -> Set[str]:
+        return {
+            column
+            for cells in timetable.values() for cell in cells
+            for column in cell
+        }
+
+    common = sorted(
+        columns(derived) & columns(scraped) - {group_header, *ignore})
+    return all(
+        _lessons(derived, day, common, group_header) == _lessons(
+            scraped, day, common, group_header)
+        for day in {*derived, *scraped})
@@ -0,0 +1,112 @@
+import ast
+import asyncio
+import json
+import logging
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+from translate import Translator
+
+SOURCE_LANGUAGE = 'en'
+LANGUAGES = ('en', 'ru', 'fr')
+CATALOG_PATH = Path(__file__).resolve().parent / 'translations.json'
+CATALOG_SOURCES = (Path(__file__).resolve().parent / 'bot.py', )
+
+
+def load_catalog(path: Path = CATALOG_PATH) -> Dict[str, Dict[str, str]]:
+    """Loads the translation catalog built by `build_catalog`"""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        logging.warning("Translation catalog %s not found" % (path))
+        return {}
+
+
+CATALOG = load_catalog()
+# Translations fetched at runtime for strings missing from the catalog
+_runtime_cache: Dict[Tuple[str, str], str] = {}
+_pending: Dict[Tuple[str, str], asyncio.Task] = {}
+
+
+def gettext(text: str, language: str) -> str:
+    """Returns the translation of text, or text itself until one is known"""
+    if language == SOURCE_LANGUAGE or language not in LANGUAGES:
+        return text
+    translated = CATALOG.get(language, {}).get(text)
+    if translated is None:
+        translated = _runtime_cache.get((text, language))
+    if translated is None:
+        _schedule_translation(text, language)
+        return text
+    return translated
+
+
+def _schedule_translation(text: str, language: str) -> None:
+    """Translates text in the background if an event loop is running"""
+    key = (text, language)
+    if key in _pending:
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    _pending[key] = loop.create_task(translate_async(text, language))
+
+
+async def translate_async(text: str, language: str) -> str:
+    """Translates text with the remote translator without blocking the loop"""
+    key = (text, language)
+    if key in _runtime_cache:
+        return _runtime_cache[key]
+    translator = Translator(from_lang=SOURCE_LANGUAGE, to_lang=language)
+    try:
+        translated = await asyncio.to_thread(translator.translate, text)
+    except Exception as e:
+        logging.warning("Could not translate %r to %s: %s" %
+                        (text, language, e))
+        return text
+    finally:
+        _pending.pop(key, None)
+    _runtime_cache[key] = translated
+    logging.info("Translated %r to %s at runtime" % (text, language))
+    return translated
+
+
+def collect_strings(sources: Iterable[Path] = CATALOG_SOURCES) -> List[str]:
+    """Collects the string literals passed to `_` or `N_` in the sources"""
+    strings = []
+    for source in sources:
+        tree = ast.parse(Path(source).read_text(encoding='utf-8'))
+        for node in ast.walk(tree):
+            if (isinstance(node, ast.Call) and isinstance(node.func, ast.Name)
+                    and node.func.id in ('_', 'N_') and node.args
+                    and isinstance(node.args[0], ast.Constant)
+                    and isinstance(node.args[0].value, str)):
+                if node.args[0].value not in strings:
+                    strings.append(node.args[0].value)
+    return strings
+
+
+def build_catalog(path: Path = CATALOG_PATH) -> None:
+    """Translates every collected string into every language and saves them.
+
+    Entries already present in the catalog are kept, so hand-made
+    corrections survive a rebuild.
+    """
+    catalog = load_catalog(path)
+    strings = collect_strings()
+    for language in LANGUAGES:
+        if language == SOURCE_LANGUAGE:
+            continue
+        translator = Translator(from_lang=SOURCE_LANGUAGE, to_lang=language)
+        entries = catalog.setdefault(language, {})
+        for text in strings:
+            if text not in entries:
+                entries[text] = translator.translate(text)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(catalog, f, ensure_ascii=False, indent=4)
+
+
+if __name__ == '__main__':
+    build_catalog()
@@ -5,28 +5,46 @@ from telegram.ext import (
     ApplicationBuilder,
     CallbackQueryHandler,
     CommandHandler,
+    InlineQueryHandler,
     MessageHandler,
     filters,
 )
 
 from bot import (
+    LANGUAGE_CALLBACK,
+    callback_dispatcher,
     day_input,
-    day_input_callback,
     group_input,
-    group_input_callback,
     help,
+    inline_query,
     language,
-    language_choice_callback,
+    load_ongoing_weeks,
     maintenance,
+    notify_timetable_changes,
+    refresh_search_indexes,
     semester_choice,
-    semester_choice_callback,
     send_daily_timetable,
     start,
+    status,
     teacher_input,
-    teacher_input_callback,
     unknown,
 )
-from config import DEBUG, MAINTENANCE, PORT, SECRET_KEY, TG_TOKEN, URL
+from config import (
+    DEBUG,
+    MAINTENANCE,
+    NOTIFY_INTERVAL,
+    PORT,
+    SEARCH_INDEX_INTERVAL,
+    SECRET_KEY,
+    TG_TOKEN,
+    URL,
+)
+from db import close_async_connections, close_connections, ensure_indexes
+
+
+async def shutdown(application) -> None:
+    await close_async_connections()
+    close_connections()
 
 
 def main():
@@ -38,48 +56,48 @@ def main():
                         level=level,
                         datefmt=log_date_format)
 
-    app = ApplicationBuilder().token(TG_TOKEN).build()
+    ensure_indexes()
+    app = ApplicationBuilder().token(TG_TOKEN).post_shutdown(shutdown).build()
 
     start_handler = CommandHandler(command='start', callback=start)
     semester_handler = CommandHandler(command='semester',
                                       callback=semester_choice)
-    semester_callback_handler = CallbackQueryHandler(
-        callback=semester_choice_callback)
     group_input_handler = CommandHandler(command='group', callback=group_input)
-    group_input_callback_handler = CallbackQueryHandler(
-        callback=group_input_callback)
     teacher_input_handler = CommandHandler(command='teacher',
                                            callback=teacher_input)
-    teacher_input_callback_handler = CallbackQueryHandler(
-        callback=teacher_input_callback)
     day_input_handler = CommandHandler(command='day', callback=day_input)
-    day_input_callback_handler = CallbackQueryHandler(
-        callback=day_input_callback)
     language_handler = CommandHandler(command='language', callback=language)
+    callback_handler = CallbackQueryHandler(callback=callback_dispatcher)
     language_callback_handler = CallbackQueryHandler(
-        callback=language_choice_callback)
+        callback=callback_dispatcher, pattern=f'^{LANGUAGE_CALLBACK}:')
+    status_handler = CommandHandler(command='status', callback=status)
+    inline_query_handler = InlineQueryHandler(callback=inline_query)
     help_handler = CommandHandler(command='help', callback=help)
     unknown_handler = MessageHandler(filters=filters.COMMAND | filters.TEXT,
                                      callback=unknown)
     maintenance_handler = MessageHandler(filters=filters.ALL,
                                          callback=maintenance)
     app.add_handler(language_handler)
-    app.add_handler(language_callback_handler, group=4)
     if not MAINTENANCE:
         app.add_handler(start_handler)
         app.add_handler(semester_handler)
-        app.add_handler(semester_callback_handler, group=2)
         app.add_handler(group_input_handler)
-        app.add_handler(group_input_callback_handler, group=1)
         app.add_handler(teacher_input_handler)
-        app.add_handler(teacher_input_callback_handler, group=0)
         app.add_handler(day_input_handler)
-        app.add_handler(day_input_callback_handler, group=3)
+        app.add_handler(callback_handler)
+        app.add_handler(status_handler)
+        app.add_handler(inline_query_handler)
         app.add_handler(help_handler)
         app.add_handler(unknown_handler)
     else:
+        app.add_handler(language_callback_handler)
         app.add_handler(maintenance_handler)
     job_queue = app.job_queue
+    job_queue.run_repeating(notify_timetable_changes, interval=NOTIFY_INTERVAL)
+    job_queue.run_once(load_ongoing_weeks, when=0)
+    job_queue.run_repeating(refresh_search_indexes,
+                            interval=SEARCH_INDEX_INTERVAL,
+                            first=0)
     if DEBUG:
         job_queue.run_daily(send_daily_timetable,
                             time=datetime.time(hour=11, minute=35, second=0))
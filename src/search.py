@@ -0,0 +1,92 @@
+import bisect
+import heapq
+import re
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+def normalize(text: str) -> str:
+    """Lowercases text and drops anything but letters and digits, so that
+    "СУЛА-308С" and "сула 308с" compare equal"""
+    return re.sub(r'[\W_]+', '', text.lower().replace('ё', 'е'))
+
+
+def trigrams(key: str) -> Set[str]:
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """Finds group or teacher names by prefix, or by trigrams on typos.
+
+    Prefixes match the start of the name or of any of its words, so a
+    teacher is found by first name too. Results are ranked: exact match,
+    then name prefix, then word prefix, then trigram similarity, shorter
+    names first. Lookups never leave the process.
+    """
+
+    def __init__(self, names: Iterable[str] = (),
+                 min_similarity: float = 0.3):
+        self.min_similarity = min_similarity
+        self.rebuild(names)
+
+    def rebuild(self, names: Iterable[str]) -> None:
+        """Replaces the indexed names"""
+        exact: Dict[str, str] = {}
+        prefixes: List[Tuple[str, int, str]] = []
+        postings: Dict[str, List[str]] = defaultdict(list)
+        sizes: Dict[str, int] = {}
+        for name in sorted(set(names)):
+            key = normalize(name)
+            if not key:
+                continue
+            exact.setdefault(key, name)
+            words = name.split()
+            for i in range(len(words)):
+                prefixes.append((normalize(' '.join(words[i:])), i, name))
+            name_trigrams = trigrams(key)
+            sizes[name] = len(name_trigrams)
+            for trigram in name_trigrams:
+                postings[trigram].append(name)
+        prefixes.sort()
+        self._exact = exact
+        self._prefixes = prefixes
+        self._postings = dict(postings)
+        self._sizes = sizes
+
+    def __len__(self) -> int:
+        return len(self._exact)
+
+    def get(self, query: str) -> Optional[str]:
+        """Returns the name equal to query, ignoring case and punctuation"""
+        return self._exact.get(normalize(query))
+
+    def search(self, query: str, limit: int = 10) -> List[str]:
+        """Returns the `limit` best matching names, best first"""
+        key = normalize(query)
+        if not key:
+            return []
+        ranks: Dict[str, Tuple] = {}
+        prefixes = self._prefixes
+        i = bisect.bisect_left(prefixes, (key, ))
+        while i < len(prefixes) and prefixes[i][0].startswith(key):
+            prefix, word, name = prefixes[i]
+            rank = (0 if prefix == key and word == 0 else min(word, 1) + 1, 0)
+            if name not in ranks or rank < ranks[name]:
+                ranks[name] = rank
+            i += 1
+        if len(ranks) < limit:
+            query_trigrams = trigrams(key)
+            shared = Counter(name for trigram in query_trigrams
+                             for name in self._postings.get(trigram, ()))
+            for name, count in shared.items():
+                if name in ranks:
+                    continue
+                similarity = count / (len(query_trigrams) + self._sizes[name] -
+                                      count)
+                if similarity >= self.min_similarity:
+                    ranks[name] = (3, -similarity)
+        return heapq.nsmallest(
+            limit,
+            ranks,
+            key=lambda name: (*ranks[name], len(name), name))
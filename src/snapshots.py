@@ -0,0 +1,100 @@
+import datetime
+import gzip
+import hashlib
+from typing import Dict, Iterator, Optional, Tuple
+
+import gridfs
+import pymongo
+import pymongo.database
+
+import config
+from db import get_db
+
+
+def digest(source: str) -> str:
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+class SnapshotStore:
+    """Raw ISU pages kept in GridFS, gzipped and addressed by their digest.
+
+    Pages live in the `snapshots` bucket under their digest, so a page
+    fetched many times is stored once. Each fetched entity has a reference
+    in `snapshot_refs` holding the digest of its last fetch, its name and
+    when it was fetched. Both are in the shared database, so every worker
+    sees the pages fetched by the others.
+    """
+
+    def __init__(self, database: pymongo.database.Database):
+        self.files = gridfs.GridFS(database, collection='snapshots')
+        self.objects = database['snapshots.files']
+        self.references = database['snapshot_refs']
+
+    def get_ref(self, semester: int, what_show: int,
+                value: int) -> Optional[Dict]:
+        return self.references.find_one(
+            {
+                'semester': semester,
+                'what_show': what_show,
+                'value': value
+            }, {'_id': 0})
+
+    def put(self, semester: int, what_show: int, value: int, name: str,
+            source: str) -> Tuple[str, bool]:
+        """Stores a fetched page and returns its digest and if it changed"""
+        page_digest = digest(source)
+        if not self.files.exists(page_digest):
+            try:
+                self.files.put(gzip.compress(source.encode('utf-8')),
+                               _id=page_digest)
+            except gridfs.errors.FileExists:
+                # Stored meanwhile by another worker
+                pass
+        previous = self.references.find_one_and_update(
+            {
+                'semester': semester,
+                'what_show': what_show,
+                'value': value
+            }, {
+                '$set': {
+                    'name': name,
+                    'digest': page_digest,
+                    'fetched_at': datetime.datetime.now(),
+                }
+            },
+            upsert=True)
+        changed = previous is None or previous['digest'] != page_digest
+        return page_digest, changed
+
+    def load(self, page_digest: str) -> str:
+        return gzip.decompress(self.files.get(page_digest).read()).decode(
+            'utf-8')
+
+    def refs(self, semester: int) -> Iterator[Dict]:
+        """Yields the references of a semester with their WhatShow and id"""
+        yield from self.references.find({'semester': semester}, {'_id': 0})
+
+    def prune(self, grace: float = config.SNAPSHOT_PRUNE_GRACE) -> int:
+        """Deletes the pages no reference points to anymore.
+
+        Pages uploaded less than `grace` seconds ago are kept, as their
+        reference may not be written yet. Returns how many were deleted.
+        """
+        referenced = set(self.references.distinct('digest'))
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+            seconds=grace)
+        pruned = 0
+        for document in self.objects.find({'uploadDate': {
+                '$lt': cutoff
+        }}, {'_id': 1}):
+            if document['_id'] not in referenced:
+                self.files.delete(document['_id'])
+                pruned += 1
+        return pruned
+
+
+def get_snapshot_store() -> Optional[SnapshotStore]:
+    """Returns the shared store, or None if snapshots are disabled"""
+    if not config.SNAPSHOTS:
+        return None
+    return SnapshotStore(get_db())
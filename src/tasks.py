@@ -1,16 +1,66 @@
-import concurrent.futures
+import asyncio
 import datetime
+import json
+import logging
+import random
+import time
+import uuid
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
-from celery import Celery, schedules
+import pymongo
+from celery import Celery, chain, chord, schedules, signals
+from pymongo import UpdateOne
 
 import config
+from cache import GENERATION_KEY, timetable_key
 from db import (
+    bulk_write_in_batches,
+    close_connections,
+    ensure_indexes,
     get_groups_collection,
     get_redis_connection,
     get_teachers_collection,
     get_timetables_collection,
 )
-from timetable_scraper import TimetableScraper2
+from derive import invert_timetables, name_key, same_lessons
+from snapshots import get_snapshot_store
+from timetable_parser import parse_timetable
+from timetable_scraper import (
+    TimetableScraper2,
+    new_parse_executor,
+    scrape_lists,
+    scrape_timetables,
+)
+from utils import (
+    CHANGES_KEY,
+    LAST_RUN_KEY,
+    LISTS_VERSION_KEY,
+    compose_timetable,
+    compose_timetables,
+    diff_timetables,
+    timetable_hash,
+)
+from week import load_calibration, week_key, week_number
+
+SEMESTERS = tuple(TimetableScraper2.SEMESTER_IDS)
+# Rooms only have timetables derived from the group ones
+ENTITY_FIELDS = ('group', 'teacher', 'room')
+# Ledger of the ongoing timetables refresh: the id of the run, its shards
+# and the results of the shards done so far
+REFRESH_RUN_KEY = 'timetables:refresh:run'
+REFRESH_SHARDS_KEY = 'timetables:refresh:{run}:shards'
+REFRESH_DONE_KEY = 'timetables:refresh:{run}:done'
+REFRESH_STARTED_KEY = 'timetables:refresh:{run}:started'
+# Held by the running refresh pipeline, and the durations of its stages
+PIPELINE_LOCK_KEY = 'timetables:pipeline:lock'
+PIPELINE_STAGES_KEY = 'timetables:pipeline:{run}:stages'
+# Deletes the lock only if it still holds the given run's id
+RELEASE_LOCK_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
 
 app = Celery('tasks',
              broker=config.CELERY_BROKER_URL,
@@ -18,24 +68,36 @@ app = Celery('tasks',
 app.autodiscover_tasks()
 
 
+@signals.worker_init.connect
+def on_worker_init(*args, **kwargs):
+    ensure_indexes()
+
+
+@signals.worker_process_shutdown.connect
+def on_worker_process_shutdown(*args, **kwargs):
+    close_connections()
+
+
 @app.task
 def update_group_collection() -> None:
     """Updates the groups collection in the database"""
     groups_db = get_groups_collection()
-    for semester in range(1, 3):
-        scraper = TimetableScraper2(semester=semester)
-        groups = scraper.get_list_of(group=True)
+    now = datetime.datetime.now()
+    operations = []
+    lists = asyncio.run(scrape_lists(SEMESTERS, group=True))
+    for semester, groups in lists.items():
         for value, name in groups:
-            groups_db.update_one({
-                'name': name,
-                'semester': semester,
-            }, {
-                '$set': {
+            operations.append(
+                UpdateOne({
+                    'name': name,
+                    'semester': semester,
+                }, {'$set': {
                     'value': value,
-                    'last_updated': datetime.datetime.now()
-                }
-            },
-                                 upsert=True)
+                    'last_updated': now
+                }},
+                          upsert=True))
+    bulk_write_in_batches(groups_db, operations)
+    get_redis_connection().incr(LISTS_VERSION_KEY)
 
 
 @app.task
@@ -43,90 +105,647 @@ def update_teacher_collection() -> None:
     """Updates the teachers collection in the database"""
 
     teachers_db = get_teachers_collection()
-    for semester in range(1, 3):
-        scraper = TimetableScraper2(semester=semester)
-        teachers = scraper.get_list_of(teacher=True)
+    now = datetime.datetime.now()
+    operations = []
+    lists = asyncio.run(scrape_lists(SEMESTERS, teacher=True))
+    for semester, teachers in lists.items():
         for value, name in teachers:
-            teachers_db.update_one({
-                'name': name,
-                'semester': semester,
-            }, {
-                '$set': {
+            operations.append(
+                UpdateOne({
+                    'name': name,
+                    'semester': semester,
+                }, {'$set': {
                     'value': value,
-                    'last_updated': datetime.datetime.now()
-                }
-            },
-                                   upsert=True)
+                    'last_updated': now
+                }},
+                          upsert=True))
+    bulk_write_in_batches(teachers_db, operations)
+    get_redis_connection().incr(LISTS_VERSION_KEY)
 
 
-@app.task
-def update_timetables_collection() -> None:
-    """Updates the timetables collection in the database"""
-    scraper = TimetableScraper2(semester=2)
+def _timetable_updates(items: Iterable[Dict],
+                       timetables_db: pymongo.collection.Collection,
+                       semester: int, hashes: Dict[Tuple[str, str], str],
+                       checked: List[Tuple[str, str]],
+                       changed: List[Dict],
+                       notices: List[Dict],
+                       fields: Dict = None) -> Iterator[UpdateOne]:
+    """Yields an upsert per changed scraped timetable of a semester.
+
+    Every scraped entity is appended to `checked`, and those whose content
+    hash differs from the stored one to `changed`. Changes to timetables
+    we already had are described per day in `notices`. Items without a
+    timetable, whose page didn't change, are only checked. The digest of
+    an item's page is stored along with its timetable, so the page is
+    only skipped once its timetable is written. `fields` are also set on
+    the changed documents.
+    """
+    for item in items:
+        timetable = item.pop('timetable')
+        page_digest = item.pop('digest', None)
+        (field, name), = item.items()
+        checked.append((field, name))
+        if timetable is None:
+            continue
+        query = {**item, 'semester': semester}
+        checksum = timetable_hash(timetable)
+        if hashes.get((field, name)) == checksum:
+            if page_digest is not None:
+                yield UpdateOne(query, {'$set': {'digest': page_digest}})
+            continue
+        changed.append(query)
+        if (field, name) in hashes:
+            previous = timetables_db.find_one(query, {'timetable': 1})
+            diff = diff_timetables(previous['timetable'], timetable)
+            if diff:
+                notices.append({**query, 'diff': diff})
+        now = datetime.datetime.now()
+        yield UpdateOne(query, {
+            '$set': {
+                **(fields or {}),
+                'timetable': timetable,
+                'hash': checksum,
+                **({
+                    'digest': page_digest
+                } if page_digest is not None else {}),
+                'last_updated': now,
+                'last_checked': now
+            }
+        },
+                        upsert=True)
+
+
+def _timetable_hashes(
+        timetables_db: pymongo.collection.Collection,
+        semester: int,
+        names: Dict[str, List[str]] = None,
+        key: str = 'hash') -> Dict[Tuple[str, str], str]:
+    """Returns the stored hashes of a semester's timetables, or only of
+    the given {field: names}, or their page digests with key='digest'"""
+    hashes = {}
+    for field in ENTITY_FIELDS:
+        if names is not None and field not in names:
+            continue
+        query = {'semester': semester, field: {'$exists': True}}
+        if names is not None:
+            query[field] = {'$in': names[field]}
+        for document in timetables_db.find(query, {
+                '_id': 0,
+                field: 1,
+                key: 1
+        }):
+            hashes[(field, document[field])] = document.get(key)
+    return hashes
+
+
+def _mark_checked(timetables_db: pymongo.collection.Collection,
+                  semester: int, checked: List[Tuple[str, str]]) -> None:
+    now = datetime.datetime.now()
+    for field in ENTITY_FIELDS:
+        names = [name for kind, name in checked if kind == field]
+        if names:
+            timetables_db.update_many(
+                {
+                    field: {
+                        '$in': names
+                    },
+                    'semester': semester
+                }, {'$set': {
+                    'last_checked': now
+                }})
+
+
+def _refresh_shards() -> List[Dict]:
+    """Splits the groups and teachers of every semester into shards.
+
+    Teachers are left out when their timetables are derived.
+    """
+    kinds = [('groups', get_groups_collection())]
+    if not config.DERIVE_TIMETABLES:
+        kinds.append(('teachers', get_teachers_collection()))
+    shards = []
+    for semester in SEMESTERS:
+        for kind, collection in kinds:
+            entities = [(document['value'], document['name'])
+                        for document in collection.find(
+                            {'semester': semester}, {
+                                '_id': 0,
+                                'value': 1,
+                                'name': 1
+                            })]
+            for i in range(0, len(entities), config.REFRESH_SHARD_SIZE):
+                shards.append({
+                    'semester': semester,
+                    kind: entities[i:i + config.REFRESH_SHARD_SIZE]
+                })
+    return shards
+
+
+@app.task(bind=True)
+def update_timetables_collection(self) -> Dict:
+    """Refreshes the timetables of every semester across the workers.
+
+    The groups and teachers are split into shards of REFRESH_SHARD_SIZE
+    entities, each scraped by a `refresh_timetable_shard` subtask, and
+    this task is replaced by `finish_timetables_refresh` once all are
+    done, then by `derive_timetables` if DERIVE_TIMETABLES is set. The
+    shards and their results are kept in Redis, so running this again
+    after an interrupted run only dispatches the unfinished shards. The
+    cache is left to `finish_refresh_pipeline`.
+    """
+    redis = get_redis_connection()
+    run = redis.get(REFRESH_RUN_KEY)
+    if run is None:
+        run = uuid.uuid4().hex
+        shards = _refresh_shards()
+        shards_key = REFRESH_SHARDS_KEY.format(run=run)
+        pipe = redis.pipeline()
+        if shards:
+            pipe.hset(shards_key,
+                      mapping={
+                          str(i): json.dumps(shard, ensure_ascii=False)
+                          for i, shard in enumerate(shards)
+                      })
+            pipe.expire(shards_key, config.REFRESH_LEDGER_TTL)
+        pipe.set(REFRESH_STARTED_KEY.format(run=run),
+                 time.time(),
+                 ex=config.REFRESH_LEDGER_TTL)
+        pipe.set(REFRESH_RUN_KEY, run, ex=config.REFRESH_LEDGER_TTL)
+        pipe.execute()
+        logging.info("Started timetables refresh %s with %s shards" %
+                     (run, len(shards)))
+    else:
+        run = run.decode('utf-8')
+        logging.info("Resuming timetables refresh %s" % (run))
+    shards = redis.hkeys(REFRESH_SHARDS_KEY.format(run=run))
+    done = set(redis.hkeys(REFRESH_DONE_KEY.format(run=run)))
+    pending = sorted((shard for shard in shards if shard not in done), key=int)
+    if pending:
+        refresh = chord((refresh_timetable_shard.s(run, shard.decode('utf-8'))
+                         for shard in pending),
+                        finish_timetables_refresh.s(run))
+    else:
+        refresh = finish_timetables_refresh.si([], run)
+    if config.DERIVE_TIMETABLES:
+        refresh |= derive_timetables.s()
+    return self.replace(refresh)
+
+
+@app.task(acks_late=True)
+def refresh_timetable_shard(run: str, shard: str) -> Dict:
+    """Scrapes and saves the timetables of one shard of a refresh run"""
+    redis = get_redis_connection()
+    done_key = REFRESH_DONE_KEY.format(run=run)
+    result = redis.hget(done_key, shard)
+    if result is not None:
+        return json.loads(result)
+    payload = json.loads(redis.hget(REFRESH_SHARDS_KEY.format(run=run), shard))
+    semester = payload['semester']
+    entities = {
+        kind: [tuple(entity) for entity in payload.get(kind, [])]
+        for kind in ('groups', 'teachers')
+    }
     timetables_db = get_timetables_collection()
-    groups_db = get_groups_collection()
-    groups = groups_db.find({})
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        futures = [(executor.submit(scraper.get_timetable_dict,
-                                    group=(group['value'], group['name'])))
-                   for group in groups]
-        for future in concurrent.futures.as_completed(futures):
-            item = future.result()
-            timetable = item.pop('timetable')
-            timetables_db.update_one({
-                **item,
-            }, {
-                '$set': {
-                    'timetable': timetable,
-                    'last_updated': datetime.datetime.now()
-                }
-            }, True)
+    names = {
+        'group': [name for _, name in entities['groups']],
+        'teacher': [name for _, name in entities['teachers']]
+    }
+    hashes = _timetable_hashes(timetables_db, semester, names)
+    # Compared with the digests stored with the timetables, not with the
+    # snapshots, so a page is skipped only once its timetable is in the
+    # database
+    digests = _timetable_hashes(timetables_db, semester, names, 'digest')
+    scraped, _ = asyncio.run(
+        scrape_timetables({semester: entities}, get_snapshot_store(),
+                          {semester: digests}))
+    checked = []
+    changed = []
+    notices = []
+    bulk_write_in_batches(
+        timetables_db,
+        _timetable_updates(scraped[semester], timetables_db, semester, hashes,
+                           checked, changed, notices))
+    _mark_checked(timetables_db, semester, checked)
+    result = {'checked': len(checked), 'changed': changed, 'notices': notices}
+    pipe = redis.pipeline()
+    pipe.hset(done_key, shard, json.dumps(result, ensure_ascii=False))
+    pipe.expire(done_key, config.REFRESH_LEDGER_TTL)
+    pipe.execute()
+    return result
+
+
+@app.task
+def finish_timetables_refresh(results: List[Dict], run: str) -> Dict:
+    """Ends a refresh run and sums up its shards.
 
+    Results are read from the ledger rather than `results`, which lacks
+    the shards done before the run was resumed. Returns the changed
+    entities, e.g. [{'group': 'СУЛА-308С', 'semester': 2}, ...], their
+    notices, how many timetables were checked and the run's duration.
+    """
+    redis = get_redis_connection()
+    current = redis.get(REFRESH_RUN_KEY)
+    if current is None or current.decode('utf-8') != run:
+        # Another callback of the same run already finished it
+        return {'changed': [], 'notices': [], 'checked': 0, 'seconds': 0}
+    done_key = REFRESH_DONE_KEY.format(run=run)
+    started_key = REFRESH_STARTED_KEY.format(run=run)
+    results = [json.loads(result) for result in redis.hvals(done_key)]
+    changed = [entity for result in results for entity in result['changed']]
+    notices = [notice for result in results for notice in result['notices']]
+    checked = sum(result['checked'] for result in results)
+    started = float(redis.get(started_key) or time.time())
+    logging.info("%s of %s timetables changed" % (len(changed), checked))
+    redis.delete(REFRESH_RUN_KEY, REFRESH_SHARDS_KEY.format(run=run),
+                 done_key, started_key)
+    return {
+        'changed': changed,
+        'notices': notices,
+        'checked': checked,
+        'seconds': round(time.time() - started, 3),
+    }
+
+
+@app.task
+def derive_timetables(refresh: Dict) -> Dict:
+    """Builds the teacher and room timetables from the group ones.
+
+    Teachers are matched with the teachers list by name and initials.
+    DERIVE_SPOT_CHECKS of their pages per semester are still scraped and
+    compared with the derived timetables, and mismatches are logged. The
+    derived changes are added to the summary of the refresh.
+    """
+    started = time.time()
+    timetables_db = get_timetables_collection()
     teachers_db = get_teachers_collection()
-    teachers = teachers_db.find({})
-    with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
-        futures = [(executor.submit(scraper.get_timetable_dict,
-                                    teacher=(teacher['value'],
-                                             teacher['name'])))
-                   for teacher in teachers]
-        for future in concurrent.futures.as_completed(futures):
-            item = future.result()
-            timetable = item.pop('timetable')
-            timetables_db.update_one({
-                **item,
-            }, {
-                '$set': {
+    report = {
+        'teachers': 0,
+        'rooms': 0,
+        'unknown': 0,
+        'spot_checked': 0,
+        'mismatched': []
+    }
+    for semester in SEMESTERS:
+        groups = {
+            document['group']: document['timetable']
+            for document in timetables_db.find(
+                {
+                    'semester': semester,
+                    'group': {
+                        '$exists': True
+                    }
+                }, {
+                    '_id': 0,
+                    'group': 1,
+                    'timetable': 1
+                })
+        }
+        teachers = {
+            name_key(document['name']): (document['value'], document['name'])
+            for document in teachers_db.find({'semester': semester}, {
+                '_id': 0,
+                'value': 1,
+                'name': 1
+            })
+        }
+        derived = {}
+        for value, timetable in invert_timetables(
+                groups, config.DERIVE_TEACHER_HEADER,
+                config.DERIVE_GROUP_HEADER).items():
+            teacher = teachers.get(name_key(value))
+            if teacher is None:
+                report['unknown'] += 1
+            else:
+                derived[teacher] = timetable
+        rooms = invert_timetables(groups, config.DERIVE_ROOM_HEADER,
+                                  config.DERIVE_GROUP_HEADER)
+        items = [*({
+            'teacher': name,
+            'timetable': timetable
+        } for (_, name), timetable in derived.items()), *({
+            'room': room,
+            'timetable': timetable
+        } for room, timetable in rooms.items())]
+        # Scraped timetables look different, don't notify their users of it
+        previously_derived = {
+            (field, document[field])
+            for field in ENTITY_FIELDS for document in timetables_db.find(
+                {
+                    'semester': semester,
+                    field: {
+                        '$exists': True
+                    },
+                    'derived': True
+                }, {
+                    '_id': 0,
+                    field: 1
+                })
+        }
+        checked = []
+        notices = []
+        bulk_write_in_batches(
+            timetables_db,
+            _timetable_updates(items, timetables_db, semester,
+                               _timetable_hashes(timetables_db, semester),
+                               checked, refresh['changed'], notices,
+                               {'derived': True}))
+        _mark_checked(timetables_db, semester, checked)
+        refresh['checked'] += len(checked)
+        refresh['notices'].extend(
+            notice for notice in notices
+            if any((field, notice.get(field)) in previously_derived
+                   for field in ENTITY_FIELDS))
+        report['teachers'] += len(derived)
+        report['rooms'] += len(rooms)
+
+        sample = random.sample(sorted(derived),
+                               min(config.DERIVE_SPOT_CHECKS, len(derived)))
+        if sample:
+            scraped, _ = asyncio.run(
+                scrape_timetables({semester: {'teachers': sample}}))
+            by_name = {
+                name: timetable
+                for (_, name), timetable in derived.items()
+            }
+            for item in scraped[semester]:
+                report['spot_checked'] += 1
+                if not same_lessons(by_name[item['teacher']],
+                                    item['timetable'],
+                                    config.DERIVE_GROUP_HEADER,
+                                    ignore=(config.DERIVE_TEACHER_HEADER, )):
+                    report['mismatched'].append(item['teacher'])
+    if report['mismatched']:
+        logging.warning("Derived timetables differ from ISU for %s" %
+                        (report['mismatched']))
+    report['seconds'] = round(time.time() - started, 3)
+    logging.info("Derived timetables: %s" % (report))
+    refresh['derive'] = report
+    return refresh
+
+
+@app.task
+def run_refresh_pipeline() -> Optional[str]:
+    """Refreshes the lists, then the timetables, then the cache, in order.
+
+    A run holds a Redis lock for up to PIPELINE_LOCK_TIMEOUT seconds and
+    runs starting meanwhile are skipped. Returns the id of the run, or
+    None if it was skipped.
+    """
+    redis = get_redis_connection()
+    run = uuid.uuid4().hex
+    if not redis.set(PIPELINE_LOCK_KEY,
+                     run,
+                     nx=True,
+                     ex=config.PIPELINE_LOCK_TIMEOUT):
+        logging.info("A refresh pipeline is already running, skipping")
+        return None
+    logging.info("Starting refresh pipeline %s" % (run))
+    chain(refresh_lists.si(run), update_timetables_collection.si(),
+          finish_refresh_pipeline.s(run)).apply_async(
+              link_error=release_pipeline_lock.si(run))
+    return run
+
+
+def _record_stage(run: str, stage: str, seconds: float) -> None:
+    key = PIPELINE_STAGES_KEY.format(run=run)
+    pipe = get_redis_connection().pipeline()
+    pipe.hset(key, stage, round(seconds, 3))
+    pipe.expire(key, config.PIPELINE_LOCK_TIMEOUT)
+    pipe.execute()
+
+
+@app.task
+def refresh_lists(run: str) -> None:
+    """First stage of the pipeline: updates the groups and teachers"""
+    started = time.perf_counter()
+    update_group_collection()
+    update_teacher_collection()
+    _record_stage(run, 'lists', time.perf_counter() - started)
+
+
+@app.task
+def finish_refresh_pipeline(refresh: Dict, run: str) -> Dict:
+    """Last stage of the pipeline: updates the cache and records the run.
+
+    The next cache generation is warmed and readers are moved to it only
+    if timetables changed; otherwise the current one is warmed again so
+    its entries don't expire. The record is kept under LAST_RUN_KEY.
+    """
+    redis = get_redis_connection()
+    _record_stage(run, 'timetables', refresh['seconds'])
+    if 'derive' in refresh:
+        _record_stage(run, 'derive', refresh['derive']['seconds'])
+    started = time.perf_counter()
+    generation = int(redis.get(GENERATION_KEY) or 0)
+    if refresh['changed']:
+        generation += 1
+    warm_timetable_cache(generation)
+    _record_stage(run, 'warm', time.perf_counter() - started)
+    started = time.perf_counter()
+    if refresh['changed']:
+        bump_cache_generation()
+    _queue_notices(refresh['notices'])
+    _record_stage(run, 'invalidate', time.perf_counter() - started)
+    store = get_snapshot_store()
+    if store is not None:
+        started = time.perf_counter()
+        logging.info("Pruned %s unreferenced snapshots" % (store.prune()))
+        _record_stage(run, 'prune', time.perf_counter() - started)
+    stages_key = PIPELINE_STAGES_KEY.format(run=run)
+    record = {
+        'run': run,
+        'finished_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'stages': {
+            stage.decode('utf-8'): float(seconds)
+            for stage, seconds in redis.hgetall(stages_key).items()
+        },
+        'checked': refresh['checked'],
+        'changed': len(refresh['changed']),
+        'generation': generation,
+    }
+    redis.set(LAST_RUN_KEY, json.dumps(record))
+    redis.delete(stages_key)
+    release_pipeline_lock(run)
+    logging.info("Refresh pipeline done: %s" % (record))
+    return record
+
+
+@app.task
+def release_pipeline_lock(run: str) -> None:
+    """Releases the pipeline's lock if the given run still holds it"""
+    get_redis_connection().eval(RELEASE_LOCK_SCRIPT, 1, PIPELINE_LOCK_KEY,
+                                run)
+
+
+def _switch_cache_generation(notices: List[Dict]) -> None:
+    """Warms the next cache generation, then switches readers and notifies"""
+    redis = get_redis_connection()
+    generation = int(redis.get(GENERATION_KEY) or 0) + 1
+    warm_timetable_cache(generation)
+    bump_cache_generation()
+    _queue_notices(notices)
+
+
+def _queue_notices(notices: List[Dict]) -> None:
+    if notices:
+        # Sent to the subscribed users by the bot's notify job
+        get_redis_connection().rpush(
+            CHANGES_KEY,
+            *(json.dumps(notice, ensure_ascii=False) for notice in notices))
+
+
+@app.task
+def rebuild_timetables_from_snapshots() -> Dict:
+    """Rebuilds the timetables collection from the stored ISU pages.
+
+    Needs no ISU: every page referenced for each semester is parsed
+    again, e.g. after a parser fix, and the timetables whose content
+    changed are rewritten. Pages that can't be parsed are skipped.
+    """
+    started = time.perf_counter()
+    store = get_snapshot_store()
+    if store is None:
+        raise ValueError("Snapshots are disabled, set SNAPSHOTS=1")
+    fields = {
+        what_show: field
+        for field, what_show in TimetableScraper2.WHAT_SHOW_IDS.items()
+    }
+    timetables_db = get_timetables_collection()
+    snapshots = 0
+    skipped = 0
+    changed = []
+    notices = []
+    with new_parse_executor() as executor:
+        for semester in SEMESTERS:
+            refs = [
+                ref for ref in store.refs(semester)
+                if ref['what_show'] in fields
+            ]
+            snapshots += len(refs)
+            futures = [
+                executor.submit(parse_timetable, store.load(ref['digest']))
+                for ref in refs
+            ]
+            items = []
+            for ref, future in zip(refs, futures):
+                # Pages without a timetable are stored like any other
+                try:
+                    timetable = future.result()
+                except Exception as e:
+                    logging.warning("Could not parse snapshot of %s: %s" %
+                                    (ref['name'], e))
+                    skipped += 1
+                    continue
+                items.append({
+                    fields[ref['what_show']]: ref['name'],
                     'timetable': timetable,
-                    'last_updated': datetime.datetime.now()
-                }
-            }, True)
+                    'digest': ref['digest']
+                })
+            bulk_write_in_batches(
+                timetables_db,
+                _timetable_updates(items, timetables_db, semester,
+                                   _timetable_hashes(timetables_db, semester),
+                                   [], changed, notices))
+    if changed:
+        _switch_cache_generation(notices)
+    report = {
+        'snapshots': snapshots,
+        'skipped': skipped,
+        'changed': len(changed),
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+    logging.info("Rebuilt timetables from snapshots: %s" % (report))
+    return report
 
 
 @app.task
-def clear_redis_cache() -> None:
-    """Clears the redis cache"""
+def warm_timetable_cache(generation: int = None,
+                         full_week: bool = config.CACHE_WARM_FULL_WEEK
+                         ) -> Dict:
+    """Renders every timetable message into the cache ahead of users.
+
+    Defaults to the current generation; the refresh warms the next one
+    before switching readers to it, so the switch never finds it cold.
+    Days are rendered for the weeks of today and tomorrow, so the night
+    broadcast and Sunday's look at Monday find the next week warm too.
+    """
+    started = time.perf_counter()
     redis = get_redis_connection()
-    redis.flushdb()
+    if generation is None:
+        generation = int(redis.get(GENERATION_KEY) or 0)
+    # Render the same week-filtered messages the bot will ask for
+    today = datetime.date.today()
+    weeks = {}
+    for semester in SEMESTERS:
+        calibration = load_calibration(redis.get(week_key(semester)))
+        start = (calibration['start'] if calibration else
+                 config.SEMESTER_START_DATES.get(semester))
+        weeks[semester] = sorted({
+            week_number(start, day)
+            for day in (today, today + datetime.timedelta(days=1))
+        }) if start else [None]
+    timetables_db = get_timetables_collection()
+    documents = timetables_db.find({}, {
+        '_id': 0,
+        'group': 1,
+        'teacher': 1,
+        'room': 1,
+        'semester': 1,
+        'timetable': 1
+    })
+    pipe = redis.pipeline(transaction=False)
+    entries = 0
+    for document in documents:
+        name = next(document[field] for field in ENTITY_FIELDS
+                    if field in document)
+        semester = document['semester']
+        timetable = document['timetable']
+        for week in weeks.get(semester, [None]):
+            for day in timetable:
+                pipe.set(timetable_key(name, semester, day, generation, week),
+                         compose_timetable(timetable, day, week),
+                         ex=config.CACHE_TTL)
+                entries += 1
+        if full_week:
+            pipe.set(timetable_key(name, semester, 'week', generation),
+                     '\n\n'.join(compose_timetables(timetable)),
+                     ex=config.CACHE_TTL)
+            entries += 1
+        if len(pipe) >= config.CACHE_WARM_BATCH_SIZE:
+            pipe.execute()
+    pipe.execute()
+    report = {
+        'generation': generation,
+        'weeks': weeks,
+        'entries': entries,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+    logging.info("Warmed timetable cache: %s" % (report))
+    return report
+
+
+@app.task
+def bump_cache_generation() -> int:
+    """Switches readers to a new cache generation.
+
+    Entries of the previous generation are left to expire by TTL instead
+    of being flushed, along with anything else sharing the Redis database.
+    """
+    redis = get_redis_connection()
+    generation = redis.incr(GENERATION_KEY)
+    logging.info("Cache generation bumped to %s" % (generation))
+    return generation
 
 
 @app.on_after_configure.connect
 def run_periodic_tasks(sender, *args, **kwargs):
-    sender.add_periodic_task(schedules.crontab(hour='*/5'),
-                             update_timetables_collection.s(),
-                             name='update timetables collection')
-    sender.add_periodic_task(schedules.crontab(hour='*/5'),
-                             update_group_collection.s(),
-                             name='update group collection')
-    sender.add_periodic_task(schedules.crontab(hour='*/5'),
-                             update_teacher_collection.s(),
-                             name='update teacher collection')
-    sender.add_periodic_task(schedules.crontab(hour='*/5'),
-                             clear_redis_cache.s(),
-                             name='clear redis cache')
+    sender.add_periodic_task(schedules.crontab(minute=0, hour='*/5'),
+                             run_refresh_pipeline.s(),
+                             name='refresh pipeline')
 
 
 if __name__ == '__main__':
-    update_group_collection()
-    update_teacher_collection()
-    clear_redis_cache()
-    update_timetables_collection()
\ No newline at end of file
+    # Run the refresh's subtasks in this process
+    app.conf.task_always_eager = True
+    ensure_indexes()
+    run_refresh_pipeline()
\ No newline at end of file
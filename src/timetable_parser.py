@@ -0,0 +1,97 @@
+import argparse
+import logging
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import lxml.html
+from pyquery.text import extract_text
+from requests_html import HTML
+
+
+def parse_timetable(source: str) -> Dict[str, List[Dict[str, str]]]:
+    """Parses an ISU timetable page into {day: [{header: value}, ...]}.
+
+    Walks the first table of the page with lxml and reads each cell's text
+    once, the same way requests_html does, so the result is identical to
+    `parse_timetable_requests_html`.
+    """
+    document = lxml.html.fromstring(source)
+    table = next(document.iter('table'), None)
+    if table is None:
+        raise ValueError("No timetable found.")
+
+    # Raised as ValueError rather than StopIteration, which asyncio cannot
+    # pass through the future of a parse run in an executor
+    table_header = next(table.iter('thead'), None)
+    table_body = next(table.iter('tbody'), None)
+    if table_header is None or table_body is None:
+        raise ValueError("No timetable found.")
+    headers = [extract_text(td) for td in table_header.iter('td')]
+    timetables_dict = {}
+    day = None
+    for row in table_body.iter('tr'):
+        cells = [extract_text(td) for td in row.iter('td')]
+        if cells[0] != "" and cells[0] not in timetables_dict:
+            day = cells[0]
+            timetables_dict[day] = []
+        if day is not None:
+            timetables_dict[day].append(dict(zip(headers[1:], cells[1:])))
+    return timetables_dict
+
+
+def parse_timetable_requests_html(
+        source: str) -> Dict[str, List[Dict[str, str]]]:
+    """The former requests_html parser, kept to check `parse_timetable`"""
+    html = HTML(html=source)
+    timetable_table = html.find("table", first=True)
+    if not timetable_table:
+        raise ValueError("No timetable found.")
+
+    table_header = timetable_table.find("thead", first=True)
+    headers = []
+    for td in table_header.find("td"):
+        headers.append(td.text)
+    timetables_dict = {}
+    table_body = timetable_table.find("tbody", first=True)
+    day = None
+    for row in table_body.find("tr"):
+        cells = row.find("td")
+        if cells[0].text != "" and cells[0].text not in timetables_dict:
+            day = cells[0].text
+            timetables_dict[day] = []
+        if day is not None:
+            timetable = {}
+            for header, cell in zip(headers[1:], cells[1:]):
+                timetable[header] = cell.text
+            timetables_dict[day].append(timetable)
+    return timetables_dict
+
+
+def benchmark(sources: List[str], repeat: int = 5) -> Dict[str, float]:
+    """Returns the pages parsed per second by both parsers"""
+    report = {}
+    for parser in (parse_timetable, parse_timetable_requests_html):
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for source in sources:
+                parser(source)
+        elapsed = time.perf_counter() - started
+        report[parser.__name__] = round(len(sources) * repeat / elapsed, 1)
+    return report
+
+
+if __name__ == '__main__':
+    # Checks both parsers agree on saved ISU pages and compares their speed:
+    # python timetable_parser.py pages/*.html
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('pages', nargs='+', type=Path)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    sources = [page.read_text(encoding='utf-8') for page in args.pages]
+    for page, source in zip(args.pages, sources):
+        if parse_timetable(source) != parse_timetable_requests_html(source):
+            raise SystemExit(f"Parsers disagree on {page}")
+    logging.info("Both parsers agree on %s pages" % (len(sources)))
+    logging.info("Pages per second: %s" % (benchmark(sources, args.repeat)))
@@ -1,7 +1,16 @@
+import asyncio
+import concurrent.futures
+import importlib.util
 import logging
-from dataclasses import dataclass
-from typing import Tuple
-
+import multiprocessing
+import os
+import random
+import sys
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import httpx
 import requests
 from fake_useragent import UserAgent
 from requests_html import HTML
@@ -10,7 +19,10 @@ from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.webdriver import WebDriver
 from selenium.webdriver.common.by import By
 
+import config
 from config import BROWSERSTACK_ACCESS_KEY, BROWSERSTACK_USERNAME, DEBUG
+from snapshots import SnapshotStore, digest
+from timetable_parser import parse_timetable
 
 
 def get_user_agent():
@@ -18,6 +30,22 @@ def get_user_agent():
     return ua.random
 
 
+_session = None
+_session_pid = None
+
+
+def get_session() -> requests.Session:
+    """Returns this process' keep-alive session for ISU requests"""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=config.ISU_MAX_CONNECTIONS)
+        _session.mount('https://', adapter)
+        _session_pid = os.getpid()
+    return _session
+
+
 semesters = {
     1: "Осенний семестр {academic_year}",
     2: "Весенний семестр {academic_year}",
@@ -140,30 +168,7 @@ class TimetableScraper:
         return HTML(html=self.driver.page_source)
 
     def _scrape_timetable(self, html: HTML) -> dict:
-        timetable_table = html.find("table", first=True)
-        if not timetable_table:
-            raise ValueError("No timetable found.")
-
-        table_header = timetable_table.find("thead", first=True)
-        headers = []
-        for td in table_header.find("td"):
-            headers.append(td.text)
-        # logging.info(f"Headers: {headers}")
-        timetables_dict = {}
-        table_body = timetable_table.find("tbody", first=True)
-        day = None
-        for row in table_body.find("tr"):
-            cells = row.find("td")
-            if cells[0].text != "" and cells[0].text not in timetables_dict:
-                day = cells[0].text
-                timetables_dict[day] = []
-                # logging.info(f"Day: {day}")
-            if day is not None:
-                timetable = {}
-                for header, cell in zip(headers[1:], cells[1:]):
-                    timetable[header] = cell.text
-                timetables_dict[day].append(timetable)
-        return timetables_dict
+        return parse_timetable(html.html)
 
     def get_timetables_dict(self) -> dict:
         self.select_semester()
@@ -240,7 +245,12 @@ class TimetableScraper2:
         semester_id = self.SEMESTER_IDS[semester]
         self.base_url = f"https://isu.ugatu.su/api/new_schedule_api/?schedule_semestr_id={semester_id}"
 
-    def _get_timetable_source(self, *, group_id=None, teacher_id=None):
+    def _get(self, url: str) -> str:
+        response = get_session().get(url, timeout=config.ISU_TIMEOUT)
+        response.raise_for_status()
+        return response.text
+
+    def _timetable_url(self, *, group_id=None, teacher_id=None) -> str:
         if group_id:
             what_show = self.WHAT_SHOW_IDS["group"]
             select_query_name = self.TIMETABLE_SELECT_NAME["group"]
@@ -252,40 +262,20 @@ class TimetableScraper2:
         else:
             raise ValueError(
                 "One of group_id or teacher_id must be specified.")
-        url = self.base_url + "&WhatShow={what_show}&{select_query_name}={select_query_value}".format(
+        return self.base_url + "&WhatShow={what_show}&{select_query_name}={select_query_value}".format(
             what_show=what_show,
             select_query_name=select_query_name,
             select_query_value=select_query_value)
-        return requests.get(url).text
 
-    def _scrape_timetable(self, html: HTML) -> dict:
-        timetable_table = html.find("table", first=True)
-        if not timetable_table:
-            raise ValueError("No timetable found.")
-
-        table_header = timetable_table.find("thead", first=True)
-        headers = []
-        for td in table_header.find("td"):
-            headers.append(td.text)
-        # logging.info(f"Headers: {headers}")
-        timetables_dict = {}
-        table_body = timetable_table.find("tbody", first=True)
-        day = None
-        for row in table_body.find("tr"):
-            cells = row.find("td")
-            if cells[0].text != "" and cells[0].text not in timetables_dict:
-                day = cells[0].text
-                timetables_dict[day] = []
-                # logging.info(f"Day: {day}")
-            if day is not None:
-                timetable = {}
-                for header, cell in zip(headers[1:], cells[1:]):
-                    timetable[header] = cell.text
-                timetables_dict[day].append(timetable)
-        return timetables_dict
+    def _get_timetable_source(self, *, group_id=None, teacher_id=None):
+        return self._get(
+            self._timetable_url(group_id=group_id, teacher_id=teacher_id))
+
+    def _scrape_timetable(self, source: str) -> dict:
+        return parse_timetable(source)
 
     def scrape_ongoing_week(self) -> str:
-        html = HTML(html=requests.get(self.base_url).text)
+        html = HTML(html=self._get(self.base_url))
         selector = "form + div"
         div = html.find(selector, first=True)
         if not div:
@@ -303,19 +293,19 @@ class TimetableScraper2:
             raise ValueError(
                 "One of group_id or teacher_id must be specified.")
         if group:
-            html = HTML(html=self._get_timetable_source(group_id=group[0]))
+            source = self._get_timetable_source(group_id=group[0])
             return {
                 'group': group[1],
-                'timetable': self._scrape_timetable(html)
+                'timetable': self._scrape_timetable(source)
             }
         elif teacher:
-            html = HTML(html=self._get_timetable_source(teacher_id=teacher[0]))
+            source = self._get_timetable_source(teacher_id=teacher[0])
             return {
                 'teacher': teacher[1],
-                'timetable': self._scrape_timetable(html)
+                'timetable': self._scrape_timetable(source)
             }
 
-    def get_list_of(self, *, group=False, teacher=False) -> list:
+    def _list_url(self, *, group=False, teacher=False) -> Tuple[str, str]:
         if group and teacher:
             raise ValueError("Only one of group or teacher can be specified.")
         elif not group and not teacher:
@@ -328,12 +318,284 @@ class TimetableScraper2:
             url = self.base_url + "&WhatShow={what_show}".format(
                 what_show=self.WHAT_SHOW_IDS["teacher"])
             select_name = self.TIMETABLE_SELECT_NAME["teacher"]
-        html = HTML(html=requests.get(url).text)
+        return url, select_name
+
+    def _parse_list(self, source: str, select_name: str) -> list:
+        html = HTML(html=source)
         select = html.find(f"select[name='{select_name}']", first=True)
         options = select.find("option")
         return [(int(option.attrs["value"]), option.text)
                 for option in options]
 
+    def get_list_of(self, *, group=False, teacher=False) -> list:
+        url, select_name = self._list_url(group=group, teacher=teacher)
+        return self._parse_list(self._get(url), select_name)
+
+
+@dataclass
+class ScraperMetrics:
+    requests: int = 0
+    retries: int = 0
+    failures: int = 0
+    bytes: int = 0
+    parsed: int = 0
+    unchanged: int = 0
+    started: float = field(default_factory=time.perf_counter)
+
+    @property
+    def pages_per_second(self) -> float:
+        return self.requests / max(time.perf_counter() - self.started, 1e-9)
+
+
+class AsyncTimetableScraper(TimetableScraper2):
+    """Fetches ISU pages concurrently from one event loop.
+
+    Requests share a pooled httpx client, at most `per_host` of them run
+    against a host at once, and failures are retried with jittered
+    exponential backoff. Use as an async context manager:
+
+        async with AsyncTimetableScraper(semester=2) as scraper:
+            items = await scraper.get_timetable_dicts(groups=groups)
+    """
+
+    def __init__(self,
+                 *,
+                 semester,
+                 client: Optional[httpx.AsyncClient] = None,
+                 per_host: int = config.ISU_PER_HOST_CONCURRENCY,
+                 max_retries: int = config.ISU_MAX_RETRIES,
+                 metrics: Optional[ScraperMetrics] = None,
+                 host_limits: Optional[Dict[str, asyncio.Semaphore]] = None):
+        super().__init__(semester=semester)
+        self.client = client
+        self._owns_client = client is None
+        self.per_host = per_host
+        self.max_retries = max_retries
+        self.metrics = metrics or ScraperMetrics()
+        self._host_limits = {} if host_limits is None else host_limits
+
+    async def __aenter__(self) -> 'AsyncTimetableScraper':
+        if self.client is None:
+            self.client = new_async_client()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        if self._owns_client:
+            await self.client.aclose()
+            self.client = None
+
+    async def _get_async(self, url: str) -> str:
+        host = httpx.URL(url).host
+        limit = self._host_limits.setdefault(host,
+                                             asyncio.Semaphore(self.per_host))
+        attempt = 0
+        while True:
+            try:
+                async with limit:
+                    response = await self.client.get(url)
+                response.raise_for_status()
+                self.metrics.requests += 1
+                self.metrics.bytes += len(response.content)
+                return response.text
+            except httpx.HTTPError as e:
+                retryable = not isinstance(e, httpx.HTTPStatusError) or (
+                    e.response.status_code == 429
+                    or e.response.status_code >= 500)
+                if not retryable or attempt >= self.max_retries:
+                    self.metrics.failures += 1
+                    raise
+                self.metrics.retries += 1
+                await asyncio.sleep(config.ISU_RETRY_BACKOFF * 2**attempt *
+                                    random.uniform(0.5, 1.5))
+                attempt += 1
+
+    async def get_list_of_async(self, *, group=False, teacher=False) -> list:
+        url, select_name = self._list_url(group=group, teacher=teacher)
+        return self._parse_list(await self._get_async(url), select_name)
+
+    async def get_timetable_dicts(
+            self,
+            *,
+            groups: Iterable[Tuple[int, str]] = (),
+            teachers: Iterable[Tuple[int, str]] = (),
+            executor: Optional[concurrent.futures.Executor] = None,
+            snapshots: Optional[SnapshotStore] = None,
+            digests: Optional[Dict[Tuple[str, str], str]] = None,
+            fetch_workers: int = config.SCRAPE_FETCH_WORKERS,
+            parse_workers: int = config.SCRAPE_PARSE_WORKERS,
+            queue_size: int = config.SCRAPE_QUEUE_SIZE) -> List[dict]:
+        """Scrapes many timetables, skipping the ones that fail.
+
+        `fetch_workers` tasks download pages into a queue of `queue_size`
+        pages, and `parse_workers` tasks parse them in `executor` (the
+        loop's default one if None). A full queue holds the downloads back
+        until parsing catches up. A page failing to parse within
+        SCRAPE_PARSE_TIMEOUT seconds is skipped.
+
+        Parsed timetables come with the digest of their page. Pages whose
+        digest is the one in `digests`, keyed by (kind, name), aren't
+        parsed: they come back with a None timetable. Pages are also saved
+        to `snapshots` if given.
+        """
+        entities = iter([*(('group', group) for group in groups),
+                         *(('teacher', teacher) for teacher in teachers)])
+        queue = asyncio.Queue(maxsize=queue_size)
+        loop = asyncio.get_running_loop()
+        items = []
+
+        async def fetch():
+            for kind, (value, name) in entities:
+                url = self._timetable_url(**{f'{kind}_id': value})
+                try:
+                    source = await self._get_async(url)
+                except httpx.HTTPError as e:
+                    logging.warning("Could not fetch timetable %s: %s" %
+                                    (name, e))
+                    continue
+                if snapshots is not None:
+                    await asyncio.to_thread(snapshots.put, self.semester,
+                                            self.WHAT_SHOW_IDS[kind], value,
+                                            name, source)
+                page_digest = digest(source)
+                if digests is not None and digests.get(
+                    (kind, name)) == page_digest:
+                    self.metrics.unchanged += 1
+                    items.append({kind: name, 'timetable': None})
+                    continue
+                await queue.put((kind, name, source, page_digest))
+
+        async def parse():
+            while True:
+                kind, name, source, page_digest = await queue.get()
+                try:
+                    # A parse that never finishes would hold queue.join()
+                    # and the whole shard with it
+                    timetable = await asyncio.wait_for(
+                        loop.run_in_executor(executor, parse_timetable,
+                                             source),
+                        config.SCRAPE_PARSE_TIMEOUT)
+                    items.append({
+                        kind: name,
+                        'timetable': timetable,
+                        'digest': page_digest
+                    })
+                    self.metrics.parsed += 1
+                except asyncio.TimeoutError:
+                    logging.warning("Timed out parsing timetable %s" % (name))
+                except Exception as e:
+                    logging.warning("Could not parse timetable %s: %s" %
+                                    (name, e))
+                finally:
+                    queue.task_done()
+
+        parsers = [asyncio.create_task(parse()) for _ in range(parse_workers)]
+        try:
+            await asyncio.gather(*(fetch() for _ in range(fetch_workers)))
+            await queue.join()
+        finally:
+            for parser in parsers:
+                parser.cancel()
+        return items
+
+
+def new_parse_executor(
+        workers: int = config.SCRAPE_PARSE_WORKERS
+) -> concurrent.futures.Executor:
+    """Returns a pool of processes to parse pages in.
+
+    Daemonic processes, such as Celery's prefork workers, can't have
+    children, so they get a pool of threads instead.
+    """
+    billiard = sys.modules.get('billiard.process')
+    if (multiprocessing.current_process().daemon
+            or billiard is not None and billiard.current_process().daemon):
+        logging.info("Daemonic process, parsing in threads")
+        return concurrent.futures.ThreadPoolExecutor(workers)
+    return concurrent.futures.ProcessPoolExecutor(workers)
+
+
+def abandon_parse_executor(executor: concurrent.futures.Executor) -> None:
+    """Shuts a parse pool down without waiting for the parses left running.
+
+    Processes still parsing, e.g. pages that timed out, are killed. Threads
+    can't be, so theirs finish in the background.
+    """
+    processes = list((getattr(executor, '_processes', None) or {}).values())
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        if process.is_alive():
+            process.kill()
+
+
+def new_async_client() -> httpx.AsyncClient:
+    """Returns a pooled HTTP client for ISU, using HTTP/2 when possible"""
+    http2 = config.ISU_HTTP2 and importlib.util.find_spec('h2') is not None
+    return httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=config.ISU_MAX_CONNECTIONS,
+                            max_keepalive_connections=config.
+                            ISU_MAX_CONNECTIONS),
+        timeout=config.ISU_TIMEOUT,
+        http2=http2,
+        headers={'User-Agent': get_user_agent()})
+
+
+async def scrape_lists(semesters: Iterable[int],
+                       *,
+                       group=False,
+                       teacher=False) -> Dict[int, list]:
+    """Scrapes the group or teacher list of several semesters at once"""
+    semesters = list(semesters)
+    async with new_async_client() as client:
+        lists = await asyncio.gather(
+            *(AsyncTimetableScraper(semester=semester,
+                                    client=client).get_list_of_async(
+                                        group=group, teacher=teacher)
+              for semester in semesters))
+    return dict(zip(semesters, lists))
+
+
+async def scrape_timetables(
+    entities: Dict[int, Dict[str, Iterable[Tuple[int, str]]]],
+    snapshots: Optional[SnapshotStore] = None,
+    digests: Optional[Dict[int, Dict[Tuple[str, str], str]]] = None
+) -> Tuple[Dict[int, List[dict]], ScraperMetrics]:
+    """Scrapes the timetables of several semesters in one event loop.
+
+    `entities` maps a semester to its groups and teachers, e.g.
+    {2: {'groups': [(1666, 'СУЛА-308С')], 'teachers': []}}. Every semester
+    shares one connection pool, one parsing pool and one set of metrics.
+    `digests` maps a semester to the page digests of its stored
+    timetables, whose unchanged pages are then skipped.
+    """
+    metrics = ScraperMetrics()
+    host_limits = {}
+    executor = new_parse_executor()
+    try:
+        async with new_async_client() as client:
+            scrapers = {
+                semester: AsyncTimetableScraper(semester=semester,
+                                                client=client,
+                                                metrics=metrics,
+                                                host_limits=host_limits)
+                for semester in entities
+            }
+            results = await asyncio.gather(
+                *(scrapers[semester].get_timetable_dicts(
+                    groups=lists.get('groups', ()),
+                    teachers=lists.get('teachers', ()),
+                    executor=executor,
+                    snapshots=snapshots,
+                    digests=(digests or {}).get(semester))
+                  for semester, lists in entities.items()))
+    finally:
+        # Waiting for the executor would wait for the parses that timed out
+        abandon_parse_executor(executor)
+    logging.info(
+        "Scraped %s pages (%s bytes, %s parsed, %s unchanged) at %.1f pages/s, %s retries, %s failures"
+        % (metrics.requests, metrics.bytes, metrics.parsed, metrics.unchanged,
+           metrics.pages_per_second, metrics.retries, metrics.failures))
+    return dict(zip(entities, results)), metrics
+
 
 if __name__ == "__main__":
     # scraper = TimetableScraper(academic_year='2022/2023',
@@ -1,28 +1,181 @@
+import asyncio
 import datetime
+import hashlib
+import json
 import logging
-from typing import Dict, List, Tuple
+import time
+from typing import Dict, List, Optional, Tuple
 
-import pymongo
-import redis
+import motor.motor_asyncio
+import redis.asyncio
+import requests
 
+import config
+from cache import SingleFlight, TwoTierCache, cache_aside, timetable_key
 from db import (
-    get_groups_collection,
-    get_teachers_collection,
-    get_timetables_collection,
-    get_users_collection,
+    get_async_groups_collection,
+    get_async_teachers_collection,
+    get_async_users_collection,
 )
 from timetable_scraper import TimetableScraper2
+from week import (
+    dump_calibration,
+    lessons_for_week,
+    load_calibration,
+    parse_week_number,
+    semester_start,
+    week_key,
+    week_number,
+)
+
+TIMETABLE_MAX_AGE = datetime.timedelta(hours=6)
+# Redis list of timetable changes waiting to be sent to their subscribers
+CHANGES_KEY = 'timetables:changes'
+# Bumped when the group or teacher lists are rewritten, so the bot knows
+# to rebuild its name indexes
+LISTS_VERSION_KEY = 'lists:version'
+# Summary of the last successful refresh pipeline, shown by /status
+LAST_RUN_KEY = 'timetables:pipeline:last_run'
+
+
+class CircuitBreaker:
+    """Stops calling a failing service until it had time to recover.
+
+    After `failure_threshold` consecutive failures the breaker opens and
+    `allow` refuses calls for `reset_timeout` seconds, then lets a single
+    trial call through.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return False
+        self.opened_at = time.monotonic()
+        return True
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logging.warning("Circuit opened after %s failures" %
+                                (self.failures))
+            self.opened_at = time.monotonic()
+
+
+timetables_flight = SingleFlight()
+week_flight = SingleFlight()
+_week_calibrations: Dict[int, Dict] = {}
+_calibrating: Dict[int, asyncio.Task] = {}
+isu_breaker = CircuitBreaker(config.ISU_FAILURE_THRESHOLD,
+                             config.ISU_RETRY_AFTER)
+# Background refreshes in flight, one per (field, name, semester)
+_refreshing: Dict[Tuple[str, str, int], asyncio.Task] = {}
 
 
-def get_ongoing_week() -> str:
-    """Returns the number of the ongoing week"""
-    return TimetableScraper2(semester=2).scrape_ongoing_week()
+async def get_ongoing_week(redis_cache: redis.asyncio.Redis,
+                           semester: int) -> Optional[int]:
+    """Returns the number of the ongoing week of the semester.
 
+    The week is computed from the semester's start date, which is kept in
+    memory and Redis and calibrated against ISU's banner once a day in
+    the background. Returns None if the start date has never been known.
+    """
+    today = datetime.date.today()
+    calibration = _week_calibrations.get(semester)
+    if calibration is None:
+        calibration = await load_week_calibration(redis_cache, semester)
+    if calibration is None:
+        calibration = await week_flight.run(
+            semester, lambda: calibrate_week(redis_cache, semester))
+        if calibration is None:
+            return None
+    elif calibration['calibrated_on'] < today and semester not in _calibrating:
+        task = asyncio.create_task(
+            week_flight.run(semester,
+                            lambda: calibrate_week(redis_cache, semester)))
+        _calibrating[semester] = task
+        task.add_done_callback(lambda _: _calibrating.pop(semester, None))
+    return week_number(calibration['start'], today)
 
-def compose_timetable(timetable_dict: Dict, day: str) -> str:
-    """Composes a timetable for a given day"""
+
+async def load_week_calibration(redis_cache: redis.asyncio.Redis,
+                                semester: int) -> Optional[Dict]:
+    """Loads the semester's calibration from Redis, or its configured start
+    date, into memory without asking ISU"""
+    calibration = load_calibration(await redis_cache.get(week_key(semester)))
+    if calibration is None and semester in config.SEMESTER_START_DATES:
+        calibration = {
+            'start': config.SEMESTER_START_DATES[semester],
+            'calibrated_on': datetime.date.min
+        }
+    if calibration is not None:
+        _week_calibrations[semester] = calibration
+    return calibration
+
+
+async def load_week_calibrations(redis_cache: redis.asyncio.Redis) -> None:
+    """Loads the calibrations of every semester not in memory yet"""
+    for semester in TimetableScraper2.SEMESTER_IDS:
+        if semester not in _week_calibrations:
+            await load_week_calibration(redis_cache, semester)
+
+
+def known_ongoing_week(semester: int,
+                       day: datetime.date) -> Optional[int]:
+    """Returns the week of a day from the calibration already in memory,
+    or the configured start date, without any I/O"""
+    calibration = _week_calibrations.get(semester)
+    start = (calibration['start'] if calibration else
+             config.SEMESTER_START_DATES.get(semester))
+    return week_number(start, day) if start else None
+
+
+async def calibrate_week(redis_cache: redis.asyncio.Redis,
+                         semester: int) -> Optional[Dict]:
+    """Reads the ongoing week from ISU and stores the semester's start"""
+    if not isu_breaker.allow():
+        return _week_calibrations.get(semester)
+    scraper = TimetableScraper2(semester=semester)
+    try:
+        banner = await asyncio.to_thread(scraper.scrape_ongoing_week)
+        week = parse_week_number(banner)
+    except Exception as e:
+        isu_breaker.record_failure()
+        logging.warning("Could not calibrate the ongoing week: %s" % (e))
+        return _week_calibrations.get(semester)
+    isu_breaker.record_success()
+    today = datetime.date.today()
+    calibration = {
+        'start': semester_start(week, today),
+        'calibrated_on': today
+    }
+    await redis_cache.set(week_key(semester), dump_calibration(calibration))
+    _week_calibrations[semester] = calibration
+    logging.info("Semester %s started on %s" %
+                 (semester, calibration['start']))
+    return calibration
+
+
+def compose_timetable(timetable_dict: Dict,
+                      day: str,
+                      week: Optional[int] = None) -> str:
+    """Composes a timetable for a given day, and week if one is given"""
     message = [day]
-    for timetable_cell in timetable_dict[day]:
+    cells = timetable_dict[day]
+    if week is not None:
+        cells = lessons_for_week(cells, week)
+    for timetable_cell in cells:
         if len(timetable_cell) <= 2:
             # Skip if there is no lesson
             continue
@@ -34,6 +187,38 @@ def compose_timetable(timetable_dict: Dict, day: str) -> str:
     return "\n".join(message)
 
 
+def timetable_hash(timetable_dict: Dict) -> str:
+    """Returns a digest of a timetable that only changes with its content"""
+    canonical = json.dumps(timetable_dict,
+                           sort_keys=True,
+                           ensure_ascii=False,
+                           separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def _lesson_lines(timetable_dict: Dict, day: str) -> List[str]:
+    return [
+        ", ".join(value for value in cell.values() if value)
+        for cell in timetable_dict.get(day, []) if len(cell) > 2
+    ]
+
+
+def diff_timetables(old: Dict, new: Dict) -> str:
+    """Describes, day by day, the lessons removed from and added to old"""
+    message = []
+    for day in [*new, *(day for day in old if day not in new)]:
+        old_lessons = _lesson_lines(old, day)
+        new_lessons = _lesson_lines(new, day)
+        if old_lessons == new_lessons:
+            continue
+        message.append(day)
+        message.extend(f"- {lesson}" for lesson in old_lessons
+                       if lesson not in new_lessons)
+        message.extend(f"+ {lesson}" for lesson in new_lessons
+                       if lesson not in old_lessons)
+    return "\n".join(message)
+
+
 def compose_timetables(timetable_dict: Dict) -> List[str]:
     """Composes a timetable for all days"""
     messages = []
@@ -42,53 +227,130 @@ def compose_timetables(timetable_dict: Dict) -> List[str]:
     return messages
 
 
-def get_timetable(timetables_db: pymongo.collection.Collection,
-                  redis_cache: redis.Redis, user: Dict, day: str) -> str:
-    """Returns a timetable for a given user and day"""
-    user.pop('_id')
-    user.pop('user_id')
-    user.pop('username')
-    semester = user.pop('semester')
-    k, value = list(user.items())[
-        0]  # can raise IndexError if user has no group or teacher
-    key = f'{"".join(value.lower().split())}_{semester}_{day.lower()}'
-    if redis_cache.exists(key):
-        message = redis_cache.get(key).decode('utf-8')
-        logging.info("Got timetable %s from cache" % (key))
-        return message
+async def get_timetable(timetables_db: motor.motor_asyncio.
+                        AsyncIOMotorCollection, cache: TwoTierCache,
+                        user: Dict,
+                        day: str,
+                        week: Optional[int] = None) -> str:
+    """Returns a timetable for a given user and day, and week if given"""
+    semester = user['semester']
+    for k in ('group', 'teacher'):
+        if user.get(k):
+            value = user[k]
+            break
     else:
-        timetable_doc = timetables_db.find_one({k: value})
-        last_updated = timetable_doc['last_updated']
-        message = compose_timetable(timetable_doc['timetable'], day)
-        if datetime.datetime.now() - last_updated > datetime.timedelta(
-                hours=6):
-            logging.info("Timetable is outdated, scraping new one")
-            timetable_dict = scrape_new_timetable((k, value),
-                                                  semester=semester)
-            message = compose_timetable(timetable_dict['timetable'], day)
-        redis_cache.set(key, message)
-        logging.info("Saved timetable %s to cache" % (key))
-        return message
-
-
-def update_user(user_id: int, group: str = None, teacher: str = None) -> None:
+        raise IndexError("User has no group or teacher")
+    key = timetable_key(value, semester, day, await cache.generation(), week)
+
+    async def load() -> str:
+        timetable_doc = await timetables_db.find_one({
+            k: value,
+            'semester': semester
+        })
+        if timetable_doc is None:
+            raise ValueError(f"No timetable found for {value}")
+        last_checked = timetable_doc.get('last_checked',
+                                         timetable_doc['last_updated'])
+        if datetime.datetime.now() - last_checked > TIMETABLE_MAX_AGE:
+            # Serve what we have and let the refresh replace it
+            logging.info("Timetable %s is outdated, refreshing it" % (value))
+            schedule_timetable_refresh(timetables_db, cache, (k, value),
+                                       semester, week)
+        return compose_timetable(timetable_doc['timetable'], day, week)
+
+    return await cache_aside(cache, key, load, timetables_flight)
+
+
+def schedule_timetable_refresh(timetables_db: motor.motor_asyncio.
+                               AsyncIOMotorCollection, cache: TwoTierCache,
+                               query: Tuple, semester: int,
+                               week: Optional[int]) -> None:
+    """Refreshes a timetable in the background, once per entity at a time"""
+    key = (*query, semester)
+    if key in _refreshing:
+        return
+    if not isu_breaker.allow():
+        logging.info("ISU is failing, not refreshing %s" % (query[1]))
+        return
+    task = asyncio.create_task(
+        refresh_timetable(timetables_db, cache, query, semester, week))
+    _refreshing[key] = task
+    task.add_done_callback(lambda _: _refreshing.pop(key, None))
+
+
+async def refresh_timetable(timetables_db: motor.motor_asyncio.
+                            AsyncIOMotorCollection, cache: TwoTierCache,
+                            query: Tuple, semester: int,
+                            week: Optional[int]) -> None:
+    """Scrapes a timetable, saves it and re-renders its cached days"""
+    try:
+        timetable_dict = await scrape_new_timetable(query, semester=semester)
+    except requests.RequestException as e:
+        # Only ISU being unreachable or failing pauses the refreshes
+        isu_breaker.record_failure()
+        logging.warning("Could not refresh timetable %s: %s" % (query[1], e))
+        return
+    except Exception as e:
+        logging.warning("Could not refresh timetable %s: %s" % (query[1], e))
+        return
+    if timetable_dict is None:
+        logging.info("%s isn't listed in semester %s, not refreshed" %
+                     (query[1], semester))
+        return
+    isu_breaker.record_success()
+    timetable = timetable_dict['timetable']
+    k, value = query
+    checksum = timetable_hash(timetable)
+    now = datetime.datetime.now()
+    result = await timetables_db.update_one({
+        k: value,
+        'semester': semester,
+        'hash': checksum
+    }, {'$set': {
+        'last_checked': now
+    }})
+    if result.matched_count == 0:
+        await timetables_db.update_one({
+            k: value,
+            'semester': semester
+        }, {
+            '$set': {
+                'timetable': timetable,
+                'hash': checksum,
+                'last_updated': now,
+                'last_checked': now
+            }
+        },
+                                       upsert=True)
+    generation = await cache.generation()
+    await cache.set_many({
+        timetable_key(value, semester, day, generation, week):
+        compose_timetable(timetable, day, week)
+        for day in timetable
+    })
+    logging.info("Refreshed timetable %s" % (value))
+
+
+async def update_user(user_id: int,
+                      group: str = None,
+                      teacher: str = None) -> None:
     """Updates the user's group or teacher"""
-    users_db = get_users_collection()
-    user = users_db.find_one({'user_id': user_id})
-    user_semester = user.get('semester')
+    users_db = get_async_users_collection()
     if group and teacher:
         raise ValueError("You can't set both group and teacher")
     if not group and not teacher:
         raise ValueError("You must set either group or teacher")
     if group:
-        field = {'group': group}
+        field, other = {'group': group}, 'teacher'
     elif teacher:
-        field = {'teacher': teacher}
+        field, other = {'teacher': teacher}, 'group'
 
-    users_db.replace_one({'user_id': user_id}, {
-        'user_id': user_id,
-        'semester': user_semester,
-        **field
+    # Only touch the entity fields so the user's semester and language stay
+    await users_db.update_one({'user_id': user_id}, {
+        '$set': field,
+        '$unset': {
+            other: ''
+        }
     }, True)
 
 
@@ -103,19 +365,32 @@ async def send_message_by_chunks(bot, chat_id, message, chunk_size=4096):
         await bot.send_message(chat_id=chat_id, text=message[i:i + chunk_size])
 
 
-def scrape_new_timetable(query: Tuple, semester: int) -> Dict:
-    """Scrapes a new timetable"""
+async def scrape_new_timetable(query: Tuple,
+                               semester: int) -> Optional[Dict]:
+    """Scrapes a new timetable without blocking the event loop.
+
+    Returns None without asking ISU if the group or teacher isn't listed
+    in the semester.
+    """
     scraper = TimetableScraper2(semester=semester)
     if query[0] == 'group':
-        groups_db = get_groups_collection()
-        group = groups_db.find_one({'name': query[1], 'semester': semester})
-        return scraper.get_timetable_dict(group=(group['value'],
-                                                 group['name']))
+        groups_db = get_async_groups_collection()
+        group = await groups_db.find_one({
+            'name': query[1],
+            'semester': semester
+        })
+        if group is None:
+            return None
+        return await asyncio.to_thread(scraper.get_timetable_dict,
+                                       group=(group['value'], group['name']))
     elif query[0] == 'teacher':
-        teachers_db = get_teachers_collection()
-        teacher = teachers_db.find_one({
+        teachers_db = get_async_teachers_collection()
+        teacher = await teachers_db.find_one({
             'name': query[1],
             'semester': semester
         })
-        return scraper.get_timetable_dict(teacher=(teacher['value'],
-                                                   teacher['name']))
\ No newline at end of file
+        if teacher is None:
+            return None
+        return await asyncio.to_thread(scraper.get_timetable_dict,
+                                       teacher=(teacher['value'],
+                                                teacher['name']))
\ No newline at end of file
@@ -0,0 +1,84 @@
+import datetime
+import json
+import re
+from typing import Dict, List, Optional
+
+# Calibration of a semester: the Monday of its first week and the day ISU
+# was last asked for the ongoing week
+WEEK_KEY = 'ongoing_week:{semester}'
+
+
+def week_key(semester: int) -> str:
+    return WEEK_KEY.format(semester=semester)
+
+
+def parse_week_number(banner: str) -> int:
+    """Returns the week number from ISU's ongoing week banner"""
+    match = re.search(r'\d+', banner)
+    if not match:
+        raise ValueError(f"No week number in {banner!r}")
+    return int(match.group())
+
+
+def semester_start(week: int, today: datetime.date) -> datetime.date:
+    """Returns the Monday of week 1 given that today is in `week`"""
+    monday = today - datetime.timedelta(days=today.weekday())
+    return monday - datetime.timedelta(weeks=week - 1)
+
+
+def week_number(start: datetime.date, today: datetime.date) -> int:
+    return (today - start).days // 7 + 1
+
+
+def dump_calibration(calibration: Dict) -> str:
+    return json.dumps({
+        'start': calibration['start'].isoformat(),
+        'calibrated_on': calibration['calibrated_on'].isoformat(),
+    })
+
+
+def load_calibration(raw: Optional[bytes]) -> Optional[Dict]:
+    if raw is None:
+        return None
+    data = json.loads(raw)
+    return {
+        'start': datetime.date.fromisoformat(data['start']),
+        'calibrated_on': datetime.date.fromisoformat(data['calibrated_on']),
+    }
+
+
+def _takes_place(value: str, week: int) -> Optional[bool]:
+    """Tells if a lesson of the given weeks column happens during week.
+
+    Understands parity ("чет"/"нечет", or "неч."/"чет." for short) and
+    lists of weeks and ranges such as "1-8, 10". Returns None when the
+    value can't be read.
+    """
+    value = value.lower()
+    if 'неч' in value:
+        return week % 2 == 1
+    if 'чет' in value:
+        return week % 2 == 0
+    weeks = set()
+    for first, last in re.findall(r'(\d+)(?:\s*-\s*(\d+))?', value):
+        weeks.update(range(int(first), int(last or first) + 1))
+    if not weeks:
+        return None
+    return week in weeks
+
+
+def lessons_for_week(cells: List[Dict], week: int) -> List[Dict]:
+    """Drops the lessons that don't take place during the given week.
+
+    The weeks column is found by its header; lessons without one, or whose
+    weeks can't be read, are always kept.
+    """
+    kept = []
+    for cell in cells:
+        for header, value in cell.items():
+            if (header.lower().startswith('недел')
+                    and _takes_place(value, week) is False):
+                break
+        else:
+            kept.append(cell)
+    return kept
@@ -0,0 +1,8 @@
+import os
+import sys
+from pathlib import Path
+
+# config reads these at import time
+for name, value in (('DEBUG', '0'), ('MAINTENANCE', '0')):
+    os.environ.setdefault(name, value)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
@@ -0,0 +1,25 @@
+from pathlib import Path
+
+import pytest
+
+from timetable_parser import parse_timetable, parse_timetable_requests_html
+
+PAGES = Path(__file__).resolve().parent / 'pages'
+
+
+def test_parsers_agree():
+    source = (PAGES / 'timetable.html').read_text(encoding='utf-8')
+    timetable = parse_timetable(source)
+    assert timetable == parse_timetable_requests_html(source)
+    assert list(timetable) == ['Понедельник', 'Вторник', 'Среда']
+    assert len(timetable['Понедельник']) == 3
+
+
+@pytest.mark.parametrize('source', [
+    (PAGES / 'no_thead.html').read_text(encoding='utf-8'),
+    '<table><tr><td>x</td></tr></table>',
+    '<div>Нет расписания</div>',
+])
+def test_no_timetable(source):
+    with pytest.raises(ValueError):
+        parse_timetable(source)
@@ -0,0 +1,49 @@
+import datetime
+
+import pytest
+
+from week import (
+    lessons_for_week,
+    parse_week_number,
+    semester_start,
+    week_number,
+)
+
+
+def test_parse_week_number():
+    assert parse_week_number('Текущая неделя: 12') == 12
+    with pytest.raises(ValueError):
+        parse_week_number('Каникулы')
+
+
+def test_week_number():
+    start = datetime.date(2026, 9, 7)
+    assert week_number(start, start) == 1
+    assert week_number(start, datetime.date(2026, 9, 13)) == 1
+    assert week_number(start, datetime.date(2026, 9, 14)) == 2
+    assert semester_start(2, datetime.date(2026, 9, 16)) == start
+
+
+@pytest.mark.parametrize('weeks, odd, even', [
+    ('неч.', True, False),
+    ('нечет', True, False),
+    ('Нечетная', True, False),
+    ('чет.', False, True),
+    ('четная', False, True),
+])
+def test_lessons_for_week_parity(weeks, odd, even):
+    cells = [{'Дисциплина': 'История', 'Неделя': weeks}]
+    assert bool(lessons_for_week(cells, 11)) is odd
+    assert bool(lessons_for_week(cells, 12)) is even
+
+
+def test_lessons_for_week_ranges():
+    cells = [
+        {'Дисциплина': 'История', 'Неделя': '1-8, 10'},
+        {'Дисциплина': 'Физика', 'Неделя': ''},
+        {'Дисциплина': 'Химия'},
+    ]
+    assert [cell['Дисциплина'] for cell in lessons_for_week(cells, 10)
+            ] == ['История', 'Физика', 'Химия']
+    assert [cell['Дисциплина'] for cell in lessons_for_week(cells, 9)
+            ] == ['Физика', 'Химия']